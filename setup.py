@@ -31,6 +31,8 @@ setup(
         ':python_version <= "3.9"': ["requests>=2.0.0"],
         'colorful:sys_platform == "win32"': ["colorama>=0.4.4"],
         "mock": ["requests_mock>=1.9.3"],
+        "stream": ["ijson>=3.1"],
+        "async": ["aiohttp>=3.8"],
     },
     tests_require=["pytest>=2.8.0"],
 )
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NestedData traversal benchmarks on synthetic documents.
+
+examples:
+  python tests/benchmark.py suite --output baseline.json
+  python tests/benchmark.py run --depth 200 --fanout 1 --keys int
+  python tests/benchmark.py compare baseline.json current.json --threshold 0.2
+  python tests/benchmark.py yaml --size 5
+"""
+
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xenoslib import ArgMethodBase, NestedData  # noqa: E402
+from xenoslib import yaml_utils  # noqa: E402
+from xenoslib.extend import YamlConfig  # noqa: E402
+from xenoslib.tools import ConfigLoader  # noqa: E402
+
+ABSENT = "__absent__"  # never generated, so every search walks the whole document
+
+# name: (depth, fanout, keys, values, shape)
+PRESETS = {
+    "deep": (500, 1, "str", "int", "dict"),
+    "wide": (2, 400, "str", "str", "dict"),
+    "balanced": (6, 6, "str", "int", "dict"),
+    "lists": (6, 6, "int", "float", "list"),
+    "mixed": (6, 6, "mixed", "mixed", "mixed"),
+}
+
+METHODS = {
+    "find_keys": lambda nd: list(nd.find_keys(ABSENT)),
+    "find_values": lambda nd: list(nd.find_values(ABSENT)),
+    "find_keyvalues": lambda nd: list(nd.find_keyvalues(ABSENT, ABSENT)),
+    "find_any_keyvalues": lambda nd: list(nd.find_any_keyvalues(ABSENT)),
+    "find_any": lambda nd: nd.find_any(ABSENT),
+    "find_key": lambda nd: nd.find_key(ABSENT),
+    "find_value": lambda nd: nd.find_value(ABSENT),
+    "find_keyvalue": lambda nd: nd.find_keyvalue(ABSENT, ABSENT),
+    "find_many": lambda nd: nd.find_many(keys=[ABSENT], values=[ABSENT + "v"]),
+}
+
+
+def make_key(i, keys):
+    if keys == "int" or keys == "mixed" and i % 2:
+        return i
+    return f"k{i}"
+
+
+def make_value(i, values):
+    kind = ("int", "str", "float", "bool")[i % 4] if values == "mixed" else values
+    return {"int": i, "str": f"v{i}", "float": i + 0.5, "bool": bool(i % 2)}[kind]
+
+
+def make_document(depth, fanout, keys="str", values="int", shape="dict"):
+    """
+    Generate a synthetic document.
+
+    :param depth: The number of container levels.
+    :param fanout: The number of children of every container.
+    :param keys: The type of dict keys, one of str, int or mixed.
+    :param values: The type of leaf values, one of int, str, float, bool or mixed.
+    :param shape: The type of containers, one of dict, list or mixed (alternating by level).
+    :return: The document and its number of key/value nodes.
+    """
+
+    def container(level):
+        if shape == "mixed":
+            return {} if level % 2 else []
+        return {} if shape == "dict" else []
+
+    root = container(1)
+    stack = [(root, 1)]
+    count = 0
+    while stack:
+        parent, level = stack.pop()
+        for i in range(fanout):
+            if level < depth:
+                child = container(level + 1)
+                stack.append((child, level + 1))
+            else:
+                child = make_value(i, values)
+            if isinstance(parent, dict):
+                parent[make_key(i, keys)] = child
+            else:
+                parent.append(child)
+            count += 1
+    return root, count
+
+
+def measure(func, repeat, min_time=0.05):
+    """
+    Return the best time per call of several samples, and the peak traced memory of one more call.
+
+    Each sample repeats the call until it takes at least min_time, like timeit's autorange.
+    """
+    number = 1
+    while True:
+        seconds = timeit.timeit(func, number=number)
+        if seconds >= min_time:
+            break
+        number *= 2
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(timings) / number, peak
+
+
+def bench(name, depth, fanout, keys, values, shape, repeat, index):
+    """Benchmark every find_* method on one generated document."""
+    data, count = make_document(depth, fanout, keys, values, shape)
+    results = {}
+    nd = NestedData(data, index=bool(index))
+    if index:
+        seconds, peak = measure(nd.reindex, repeat)
+        results[f"{name}/reindex"] = {
+            "seconds": seconds,
+            "nodes_per_sec": count / seconds,
+            "peak_bytes": peak,
+        }
+    for method, func in METHODS.items():
+        seconds, peak = measure(lambda: func(nd), repeat)
+        results[f"{name}/{method}"] = {
+            "seconds": seconds,
+            "nodes_per_sec": count / seconds,
+            "peak_bytes": peak,
+        }
+    return count, results
+
+
+def report(results, output):
+    print(f"{'benchmark':<32}{'seconds':>12}{'nodes/s':>14}{'peak KiB':>12}")
+    for name, result in results.items():
+        print(
+            f"{name:<32}{result['seconds']:>12.6f}{result['nodes_per_sec']:>14,.0f}"
+            f"{result['peak_bytes'] / 1024:>12,.1f}"
+        )
+    if output:
+        document = {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(output, "w") as w:
+            json.dump(document, w, indent=2, sort_keys=True)
+        print(f"results saved to {output}", file=sys.stderr)
+
+
+class Benchmark(ArgMethodBase):
+    """NestedData traversal benchmarks, results are best times of --repeat runs"""
+
+    @staticmethod
+    def run(
+        depth=6, fanout=6, keys="str", values="int", shape="dict", repeat=5, index=0, output=""
+    ):
+        """benchmark one generated document"""
+        count, results = bench("custom", depth, fanout, keys, values, shape, repeat, index)
+        print(f"{count} nodes", file=sys.stderr)
+        report(results, output)
+
+    @staticmethod
+    def suite(repeat=5, index=0, output=""):
+        """benchmark the deep, wide, balanced, lists and mixed presets"""
+        results = {}
+        for name, preset in PRESETS.items():
+            results.update(bench(name, *preset, repeat, index)[1])
+        report(results, output)
+
+    @staticmethod
+    def compare(baseline, current, threshold=0.2):
+        """fail if any throughput drops or peak memory grows by more than threshold"""
+        with open(baseline) as r:
+            old = json.load(r)["results"]
+        with open(current) as r:
+            new = json.load(r)["results"]
+        failed = False
+        for name in sorted(old.keys() & new.keys()):
+            speed = new[name]["nodes_per_sec"] / old[name]["nodes_per_sec"] - 1
+            memory = (new[name]["peak_bytes"] + 1) / (old[name]["peak_bytes"] + 1) - 1
+            regressed = speed < -threshold or memory > threshold
+            failed = failed or regressed
+            mark = "REGRESSED" if regressed else ""
+            print(f"{name:<32}{speed:>+10.1%} speed{memory:>+10.1%} memory  {mark}")
+        for name in sorted(old.keys() - new.keys()):
+            print(f"{name:<32}missing from {current}")
+        return not failed
+
+    @staticmethod
+    def yaml(size=1.0, repeat=3):
+        """compare YamlConfig and ConfigLoader load/save times of the YAML backends on a file of size MB"""
+        sections = max(1, int(size * 1024 * 1024 / 850))
+        data = {
+            f"section{i}": {
+                "url": f"https://example.com/{i}",
+                "enabled": bool(i % 2),
+                "ratio": i / 7,
+                "items": [{"id": j, "name": f"item \u00e9 {j}"} for j in range(25)],
+            }
+            for i in range(sections)
+        }
+        backends = {"python": (yaml.SafeLoader, yaml.SafeDumper)}
+        if yaml_utils.YAML_BACKEND == "libyaml":
+            backends["libyaml"] = (yaml.CSafeLoader, yaml.CSafeDumper)
+        times = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "config.yml")
+            with open(path, "w", encoding="utf-8") as w:
+                yaml.safe_dump(data, w, allow_unicode=True)
+            print(f"{os.path.getsize(path) / 1024 / 1024:.1f} MB", file=sys.stderr)
+            config = YamlConfig(path)
+            for backend, (loader, dumper) in backends.items():
+                yaml_utils.SafeLoader, yaml_utils.SafeDumper = loader, dumper
+                times[backend] = [
+                    min(timeit.repeat(lambda: YamlConfig(path), number=1, repeat=repeat)),
+                    min(timeit.repeat(config.save, number=1, repeat=repeat)),
+                    min(timeit.repeat(lambda: ConfigLoader(path), number=1, repeat=repeat)),
+                ]
+        print(f"{'backend':<12}{'YamlConfig()':>14}{'save()':>14}{'ConfigLoader()':>16}")
+        for backend, (load, save, loader) in times.items():
+            print(f"{backend:<12}{load:>14.3f}{save:>14.3f}{loader:>16.3f}")
+        if "libyaml" in times:
+            speedup = [old / new for old, new in zip(times["python"], times["libyaml"])]
+            print(f"{'speedup':<12}{speedup[0]:>13.1f}x{speedup[1]:>13.1f}x{speedup[2]:>15.1f}x")
+
+
+if __name__ == "__main__":
+    Benchmark()
@@ -1,12 +1,148 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
+import copy
+import http.server
+import importlib.util
+import itertools
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
+import unittest.mock
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import yaml
 
 import xenoslib
 import xenoslib.dev
 import xenoslib.onedrive
-from xenoslib.extend import YamlConfig
-from xenoslib import NestedData
+from xenoslib.extend import AsyncRequestAdapter, ConcurrentYamlConfig, RequestAdapter, YamlConfig
+from xenoslib.tools import (
+    ConfigLoader,
+    FileWatcher,
+    ResponseCache,
+    RetryPolicy,
+    SecretCache,
+    TokenBucket,
+    VaultClientPool,
+)
+from xenoslib.yaml_utils import YAML_BACKEND, snapshot_path, yaml_dump, yaml_load, yaml_load_file
+from xenoslib import NestedData, NestedStream
+
+try:
+    from hvac.exceptions import InvalidPath, InvalidRequest
+except ImportError:  # the tests that need hvac's errors are skipped
+    InvalidPath = InvalidRequest = Exception
+
+
+class FakeVaultClient:
+    """A local stand-in for hvac.Client with KV v2 secrets by (namespace, path)."""
+
+    lock = threading.Lock()
+
+    def __init__(self, secrets, namespace=None, reads=None, logins=None):
+        self.store = secrets
+        self.versions = {}
+        self.writes = []
+        self.reads = [] if reads is None else reads
+        self.logins = [] if logins is None else logins
+        self.token = None
+        self.adapter = types.SimpleNamespace(namespace=namespace)
+        self.secrets = types.SimpleNamespace(kv=self)
+        self.auth = types.SimpleNamespace(approle=self)
+
+    def is_authenticated(self):
+        return True
+
+    def login(self, role_id, secret_id):
+        with self.lock:
+            self.logins.append(role_id)
+            token = f"token{len(self.logins)}"
+        return {"auth": {"client_token": token, "lease_duration": 100}}
+
+    def read_secret_version(self, path, mount_point="kv", raise_on_deleted_version=True):
+        with self.lock:
+            self.reads.append((self.adapter.namespace, path))
+            key = self.adapter.namespace, path
+            if key not in self.store:
+                raise InvalidPath(f"no secret at {path}")
+            version = {"version": self.versions.get(key, 1)}
+            return {"data": {"data": dict(self.store[key]), "metadata": version}}
+
+    def create_or_update_secret(self, path, secret, mount_point="kv", cas=None):
+        with self.lock:
+            key = self.adapter.namespace, path
+            version = self.versions.get(key, 1 if key in self.store else 0)
+            if cas is not None and cas != version:
+                raise InvalidRequest("check-and-set parameter did not match the current version")
+            self.writes.append(key)
+            self.store[key] = dict(secret)
+            self.versions[key] = version + 1
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    def handle_any(self):
+        self.body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        route = self.server.routes.get((self.command, self.path.split("?")[0]))
+        status, headers, body = route(self) if route else (404, {}, "not found")
+        if isinstance(body, (dict, list)):
+            body, headers = json.dumps(body), {"Content-Type": "application/json", **headers}
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = handle_any
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """A local HTTP server answering (method, path) with route(handler) -> (status, headers, body)."""
+
+    daemon_threads = True
+
+    def __init__(self, routes):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.routes = routes
+        self.url = f"http://127.0.0.1:{self.server_port}"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def increment_counter(path, times):
+    config = ConcurrentYamlConfig(path)
+    for _ in range(times):
+        with config.locked():
+            config["counter"] = config.get("counter", 0) + 1
+
+
+def delete_key(path, key):
+    config = ConcurrentYamlConfig(path)
+    with config.locked():
+        del config[key]
+
+
+def is_even_id(k, v):
+    return k == "id" and v % 2 == 0
 
 
 class UnitTest(unittest.TestCase):
@@ -65,6 +201,591 @@ class UnitTest(unittest.TestCase):
         self.assertEqual(id(config), id(config2))
         self.assertNotEqual(id(config), id(config3))
 
+    def test_yaml_utils(self):
+        self.assertIn(YAML_BACKEND, ("libyaml", "python"))
+        data = {"a": ["\u00e9", 1.5, None, {"b": True}]}
+        self.assertEqual(yaml_dump(data), yaml.safe_dump(data, allow_unicode=True))
+        self.assertEqual(yaml_load(yaml_dump(data)), data)
+        self.assertRaises(yaml.YAMLError, yaml_load, "!!python/object:os.system {}")
+
+    def test_yamlconfig_save_delay(self):
+        class DelayedYamlConfig(YamlConfig):
+            save_delay = 0.01
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "config.yml")
+            config = DelayedYamlConfig(path)
+            config["a"] = 1
+            config.save()
+            config["a"] = 2
+            config.save()
+            for _ in range(200):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.01)
+            self.assertEqual(DelayedYamlConfig(path).a, 2)
+            inode = os.stat(path).st_ino
+            config.flush()  # unchanged, so not written
+            self.assertEqual(os.stat(path).st_ino, inode)
+            config["b"] = 3
+            config.save()
+            config.flush()
+            self.assertEqual(yaml_load_file(path), {"a": 2, "b": 3})
+            config["c"] = 4
+            failing = unittest.mock.patch("xenoslib.extend.atomic_write", side_effect=OSError)
+            with failing, self.assertLogs("xenoslib.extend", "ERROR"):
+                config.save()
+                config._save_timer.join()
+            config._flush_pending()  # as at exit, the failed write is still pending
+            self.assertEqual(yaml_load_file(path)["c"], 4)
+
+    @unittest.skipUnless(sys.platform == "linux", "needs fork and fcntl")
+    def test_concurrent_yamlconfig(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "config.yml")
+            config = ConcurrentYamlConfig(path)
+            self.assertIsNot(config, YamlConfig(path))
+            threads = [
+                threading.Thread(target=increment_counter, args=(path, 20)) for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            context = multiprocessing.get_context("fork")
+            processes = [
+                context.Process(target=increment_counter, args=(path, 20)) for _ in range(2)
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertEqual(yaml_load_file(path), {"counter": 120})
+            self.assertEqual(ConcurrentYamlConfig(path), {"counter": 120})
+            with config.locked():
+                config["x"] = 1
+            process = context.Process(target=delete_key, args=(path, "x"))
+            process.start()
+            process.join()
+            with config.locked():  # reloads without the key the other process deleted
+                config["counter"] += 1
+            self.assertEqual(yaml_load_file(path), {"counter": 121})
+            other_path = os.path.join(tmp, "other.yml")
+            with config.locked():
+                waiting = threading.Thread(target=ConcurrentYamlConfig, args=(path,), daemon=True)
+                waiting.start()  # waits for the file lock
+                time.sleep(0.05)
+                other = threading.Thread(
+                    target=ConcurrentYamlConfig, args=(other_path,), daemon=True
+                )
+                other.start()
+                other.join(5)
+                self.assertFalse(other.is_alive())  # not blocked by the waiting construction
+            waiting.join()
+            parsing, parsed = threading.Event(), threading.Event()
+
+            def slow_load(*args, **kwargs):
+                parsing.set()
+                parsed.wait(10)
+                return {"counter": 122}
+
+            with unittest.mock.patch("xenoslib.extend.yaml_load_file", slow_load):
+                reader = threading.Thread(target=ConcurrentYamlConfig, args=(path,))
+                reader.start()
+                self.assertTrue(parsing.wait(5))
+                self.assertTrue(config._lock.acquire(timeout=2))  # not held while parsing
+                config._lock.release()
+                parsed.set()
+                reader.join()
+            self.assertEqual(config["counter"], 122)
+
+    def test_yaml_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "config.yml")
+            xenoslib.atomic_write(path, "a: 1\n")
+            self.assertEqual(yaml_load_file(path, snapshot=True), {"a": 1})
+            with open(snapshot_path(path), "rb") as r:
+                key = pickle.load(r)
+            with open(snapshot_path(path), "wb") as w:
+                pickle.dump(key, w)
+                pickle.dump({"a": "from snapshot"}, w)
+            self.assertEqual(yaml_load_file(path, snapshot=True), {"a": "from snapshot"})
+            self.assertEqual(yaml_load_file(path), {"a": 1})
+            os.chmod(path, 0o600)
+            xenoslib.atomic_write(path, "a: 2\n")
+            self.assertEqual(yaml_load_file(path, snapshot=True), {"a": 2})
+            if os.name == "posix":  # Windows only reports 0o666 or 0o444
+                self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+                self.assertEqual(os.stat(snapshot_path(path)).st_mode & 0o777, 0o600)
+            with open(snapshot_path(path), "wb") as w:
+                w.write(b"corrupt")
+            self.assertEqual(yaml_load_file(path, snapshot=True), {"a": 2})
+
+    def test_yamlconfig_check_stat(self):
+        class StatYamlConfig(YamlConfig):
+            check_stat = True
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "config.yml")
+            with open(path, "w") as w:
+                w.write("a: 1\n")
+            config = StatYamlConfig(path)
+            self.assertIs(StatYamlConfig(path), config)
+            self.assertEqual(config.cache_info(), (1, 1))
+            with open(path, "w") as w:
+                w.write("a: 22\n")
+            self.assertEqual(StatYamlConfig(path).a, 22)
+            self.assertEqual(config.cache_info(), (1, 2))
+            config["b"] = 2
+            config.save()
+            StatYamlConfig(path)
+            self.assertEqual(config.cache_info(), (2, 2))
+
+
+class TestConfigLoader(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "config.yml")
+        xenoslib.atomic_write(self.path, "a: {x: 1}\nb: {y: 2}\n")
+
+    def test_file_watcher(self):
+        for use_inotify in (True, False):
+            changed = threading.Event()
+            watcher = FileWatcher(self.path, lambda path: changed.set(), 0.01, use_inotify)
+            watcher.start()
+            self.addCleanup(watcher.stop)
+            xenoslib.atomic_write(self.path, f"a: {{x: {use_inotify}}}\n")
+            self.assertTrue(changed.wait(5))
+            watcher.stop()
+
+    @unittest.skipUnless(hasattr(os, "symlink") and sys.platform != "win32", "needs symlinks")
+    def test_file_watcher_symlink(self):
+        root = os.path.dirname(self.path)
+        for use_inotify in (True, False):
+            # laid out like a Kubernetes ConfigMap volume
+            directory = os.path.join(root, str(use_inotify))
+            os.makedirs(os.path.join(directory, "..v1"))
+            xenoslib.atomic_write(os.path.join(directory, "..v1", "config.yml"), "a: 1\n")
+            os.symlink("..v1", os.path.join(directory, "..data"))
+            path = os.path.join(directory, "config.yml")
+            os.symlink(os.path.join("..data", "config.yml"), path)
+            changes, changed = [], threading.Event()
+
+            def callback(path):
+                changes.append(yaml_load_file(path))
+                changed.set()
+
+            watcher = FileWatcher(path, callback, 0.01, use_inotify).start()
+            self.addCleanup(watcher.stop)
+            with open(os.path.join(directory, "..v1", "config.yml"), "r+") as w:
+                w.write("a: 5\n")  # the target edited in place, not truncated to be read midway
+            self.assertTrue(changed.wait(5))
+            for version in range(2, 4):  # the ..data symlink swapped, the old version removed
+                changed.clear()
+                new, old = f"..v{version}", f"..v{version - 1}"
+                new_path, tmp_link = os.path.join(directory, new), os.path.join(directory, "..tmp")
+                os.makedirs(new_path)
+                xenoslib.atomic_write(os.path.join(new_path, "config.yml"), f"a: {version}\n")
+                os.symlink(new, tmp_link)
+                os.replace(tmp_link, os.path.join(directory, "..data"))
+                self.assertTrue(changed.wait(5))
+                shutil.rmtree(os.path.join(directory, old))
+            watcher.stop()
+            self.assertEqual(changes, [{"a": 5}, {"a": 2}, {"a": 3}])
+
+    def vault_config(self):
+        xenoslib.atomic_write(
+            self.path,
+            yaml_dump(
+                {
+                    "vault": {"url": "http://vault", "space": "ns1", "role_id": "role"},
+                    "db": {"vault_path": "app/db", "user@vault": "user", "password@vault": "pass"},
+                    "redis": {"vault_path": "app/db", "password@vault": "cache_pass"},
+                    "api": {"vault_path": "app/api", "vault_namespace": "ns2", "token@vault": "t"},
+                    "plain": {"url": "http://example.com"},
+                }
+            ),
+        )
+        config = ConfigLoader(self.path)
+        config.cache = SecretCache()
+        config.vault_client = FakeVaultClient(
+            {
+                ("ns1", "app/db"): {"user": "u", "pass": "p", "cache_pass": "c"},
+                ("ns2", "app/api"): {"t": "token"},
+            }
+        )
+        return config
+
+    def test_prefetch(self):
+        config = self.vault_config()
+        self.assertEqual(config.prefetch("db"), 2)
+        self.assertEqual(config.vault_client.reads, [("ns1", "app/db")])
+        self.assertEqual(config.prefetch(), 4)
+        self.assertEqual(len(config.vault_client.reads), 3)
+        self.assertEqual(config.db.password, "p")
+        self.assertEqual(config.redis.password, "c")
+        self.assertEqual(config["api"]["token"], "token")
+        self.assertEqual(len(config.vault_client.reads), 3)
+        with self.assertRaisesRegex(KeyError, "Section 'missing' not found"):
+            config.prefetch("missing")
+
+    def test_vault_pool(self):
+        config = self.vault_config()
+        store, reads, logins = config.vault_client.store, [], []
+        now = [0]
+        pool = VaultClientPool(
+            "http://vault",
+            "ns1",
+            "role",
+            "secret",
+            client_factory=lambda ns, token: FakeVaultClient(store, ns, reads, logins),
+            timer=lambda: now[0],
+        )
+        with ThreadPoolExecutor(8) as executor:
+            tokens = list(executor.map(lambda _: pool.ensure_token(), range(16)))
+        self.assertEqual(tokens, ["token1"] * 16)
+        config.vault_pool, config.vault_client = pool, pool.client()
+        self.assertEqual(config.prefetch(), 4)
+        self.assertEqual(sorted(reads), [("ns1", "app/db"), ("ns2", "app/api")])
+        self.assertEqual(config.api.token, "token")
+        now[0] = 50  # within renew_margin of the lease end
+        self.assertEqual(pool.client("ns2").token, "token2")
+        self.assertEqual(pool.client("ns1").token, "token2")
+        self.assertEqual(len(logins), 2)
+
+        pool.auth_errors = (PermissionError,)
+        client = pool.client("ns1")
+        write = client.create_or_update_secret
+
+        def revoked_write(*args, **kwargs):  # the token is revoked once
+            client.create_or_update_secret = write
+            raise PermissionError
+
+        client.create_or_update_secret = revoked_write
+        config.db.user = "u2"
+        self.assertEqual(store["ns1", "app/db"]["user"], "u2")
+        self.assertEqual(len(logins), 3)
+
+    def test_batch(self):
+        config = self.vault_config()
+        fake = config.vault_client
+        with config.batch():
+            config.db.user = "u2"
+            config.db.password = "p2"
+            config["redis"]["password"] = "c2"
+            config.api.token = "t2"
+            self.assertEqual(fake.writes, [])
+        self.assertEqual(len(fake.reads), 2)
+        self.assertEqual(sorted(fake.writes), [("ns1", "app/db"), ("ns2", "app/api")])
+        self.assertEqual(
+            fake.store["ns1", "app/db"], {"user": "u2", "pass": "p2", "cache_pass": "c2"}
+        )
+        self.assertEqual((config.db.user, config.api.token), ("u2", "t2"))
+        self.assertEqual(len(fake.reads), 2)
+
+        with self.assertRaises(ValueError):
+            with config.batch():
+                config.db.user = "discarded"
+                raise ValueError
+        self.assertEqual(fake.store["ns1", "app/db"]["user"], "u2")
+
+    @unittest.skipUnless(importlib.util.find_spec("hvac"), "needs hvac")
+    def test_write_errors(self):
+        config = self.vault_config()
+        fake = config.vault_client
+        original = fake.create_or_update_secret
+
+        def racing_write(path, secret, **kwargs):  # another writer gets in between, once
+            fake.create_or_update_secret = original
+            original(path, {**fake.store["ns1", path], "other": "x"})
+            return original(path, secret, **kwargs)
+
+        fake.create_or_update_secret = racing_write
+        config.db.user = "u3"
+        self.assertEqual(fake.store["ns1", "app/db"]["other"], "x")
+        self.assertEqual(fake.store["ns1", "app/db"]["user"], "u3")
+
+        del fake.store["ns2", "app/api"]  # a missing secret is created
+        config.api.token = "t3"
+        self.assertEqual(fake.store["ns2", "app/api"], {"t": "t3"})
+
+        fake.read_secret_version = unittest.mock.Mock(side_effect=PermissionError)
+        # other errors are not taken for a missing secret
+        with self.assertRaises(Exception) as raised:
+            config.db.user = "u4"
+        self.assertIsInstance(raised.exception.__cause__, PermissionError)
+        self.assertEqual(fake.store["ns1", "app/db"]["user"], "u3")
+
+    def test_watch(self):
+        config = ConfigLoader(self.path).watch(interval=0.01)
+        self.addCleanup(config.unwatch)
+        changes = []
+        changed = threading.Event()
+        config.on_change("a", lambda *args: changes.append(args) or changed.set())
+        config.on_change("b", lambda *args: changes.append(args) or changed.set())
+        xenoslib.atomic_write(self.path, "a: {x: 3}\nb: {y: 2}\n")
+        self.assertTrue(changed.wait(5))
+        self.assertEqual(changes, [("a", {"x": 1}, {"x": 3})])
+        self.assertEqual(ConfigLoader(self.path).a.x, 3)
+        self.assertEqual(config.reload(), [])
+
+
+class TestSecretCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.executor = ThreadPoolExecutor(1)
+        self.addCleanup(self.executor.shutdown)
+        self.cache = SecretCache(
+            maxsize=2, ttl=10, max_age=20, executor=self.executor, timer=lambda: self.now
+        )
+        self.loads = itertools.count(1)
+
+    def get(self, key="a"):
+        value = self.cache.get(key, lambda: next(self.loads))
+        self.executor.submit(lambda: None).result()  # wait for background refreshes
+        return value
+
+    def test_refresh(self):
+        self.assertEqual(self.get(), 1)
+        self.now = 7
+        self.assertEqual(self.get(), 1)  # fresh, nothing to refresh
+        self.now = 9
+        self.assertEqual(self.get(), 1)  # near expiry, refreshed in the background
+        self.assertEqual(self.get(), 2)
+        self.now = 24
+        self.assertEqual(self.get(), 2)  # stale but within max_age, refreshed in the background
+        self.now = 50
+        self.assertEqual(self.get(), 4)  # past max_age, loaded again
+        expected = {"hits": 3, "misses": 2, "stale_hits": 1, "refreshes": 2}
+        self.assertEqual({k: self.cache.metrics()[k] for k in expected}, expected)
+
+    def test_lru(self):
+        self.get("a")
+        self.get("b")
+        self.get("a")
+        self.get("c")
+        self.assertEqual(sorted(self.cache), ["a", "c"])
+        self.assertEqual(self.cache.metrics()["evictions"], 1)
+        self.assertEqual(self.cache.pop("a"), 1)
+        self.assertNotIn("a", self.cache)
+
+
+class TestRequestAdapter(unittest.TestCase):
+    def setUp(self):
+        self.active = self.max_active = 0
+        self.lock = threading.Lock()
+        self.server = StubServer(
+            {
+                ("GET", "/item"): self.slow_item,
+                ("GET", "/text"): lambda handler: (200, {}, "hello"),
+                ("GET", "/error"): lambda handler: (500, {}, "error"),
+                ("GET", "/flaky"): self.flaky,
+                ("GET", "/etag"): self.etag,
+                ("POST", "/flaky"): self.flaky,
+                ("GET", "/list"): lambda handler: (
+                    200,
+                    {},
+                    {"count": 3, "value": [{"id": i, "tags": ["a"]} for i in range(3)]},
+                ),
+            }
+        )
+        self.addCleanup(self.server.close)
+
+    def slow_item(self, handler):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        return 200, {}, {"id": handler.path.split("=")[1]}
+
+    def etag(self, handler):
+        if handler.headers.get("If-None-Match") == '"v1"':
+            return 304, {}, b""
+        self.full_responses = getattr(self, "full_responses", 0) + 1
+        return 200, {"ETag": '"v1"'}, {"items": [1, 2]}
+
+    def flaky(self, handler):
+        self.failures = getattr(self, "failures", 0) + 1
+        if self.failures <= 2:
+            return 429 if self.failures == 1 else 503, {"Retry-After": "0"}, "busy"
+        return 200, {}, {"attempts": self.failures}
+
+    def test_stream(self):
+        class Api(RequestAdapter):
+            base_url = self.server.url
+
+        api = Api()
+        expected = [{"id": i, "tags": ["a"]} for i in range(3)]
+        self.assertEqual(list(api.get("list", items="value")), expected)
+        self.assertEqual(list(api.get("list", items=("value", 1, "tags"))), ["a"])
+        self.assertEqual(list(api.get("list", items="missing")), [])
+        self.assertEqual(list(api.get("list", items="value", use_ijson=True)), expected)
+        body = b"".join(api.get("list", stream=True, chunk_size=16))
+        self.assertEqual(json.loads(body)["value"], expected)
+        self.assertEqual(api.get("list")["count"], 3)
+        with self.assertRaises(Exception):
+            api.get("error", stream=True)
+
+    def test_retry(self):
+        sleeps = []
+
+        class Api(RequestAdapter):
+            base_url = self.server.url
+            retry_policy = RetryPolicy(total=2, sleep=sleeps.append)
+            rate_limit = 1000
+
+        api = Api()
+        self.assertEqual(api.get("flaky"), {"attempts": 3})
+        self.assertEqual(sleeps, [0, 0])
+        self.failures = 0
+        with self.assertRaises(requests.HTTPError):
+            api.post("flaky")  # not idempotent
+        with self.assertRaises(requests.HTTPError):
+            api.get("error")  # retries exhausted
+        self.assertEqual(len(sleeps), 4)
+        self.assertTrue(0 <= sleeps[-1] <= 1)
+
+        class Closed(RequestAdapter):
+            base_url = "http://127.0.0.1:9"  # discard port, nothing listens
+            retry_policy = RetryPolicy(total=2, jitter=False, sleep=sleeps.append)
+
+        with self.assertRaises(requests.ConnectionError):
+            Closed().get("item")
+        self.assertEqual(sleeps[-2:], [0.5, 1])
+
+        class Slow(Api):
+            rate_limit = 1
+
+        url = f"{self.server.url}/item"
+        self.assertIsNot(Slow()._rate_limiter(url), api._rate_limiter(url))
+        self.assertIs(Api()._rate_limiter(url), api._rate_limiter(url))
+        self.assertEqual(Slow()._rate_limiter(url).rate, 1)
+
+    def test_response_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+
+            class Api(RequestAdapter):
+                base_url = self.server.url
+                response_cache = ResponseCache(maxsize=1, directory=directory)
+
+            api = Api()
+            for _ in range(3):
+                body = api.get("etag")
+                self.assertEqual(body, {"items": [1, 2]})
+                body["items"].append(3)  # changes only this caller's body
+            self.assertEqual(self.full_responses, 1)
+            self.assertEqual(Api.response_cache.metrics()["hits"], 2)
+            api.get("etag", headers={"Authorization": "Bearer other"})  # another user
+            self.assertEqual(self.full_responses, 2)
+            Api.response_cache = ResponseCache(directory=directory)  # as in a new process
+            self.assertEqual(api.get("etag"), {"items": [1, 2]})
+            self.assertEqual(self.full_responses, 2)
+            self.assertEqual(Api.response_cache.metrics()["disk_hits"], 1)
+            self.assertEqual(api.get("text").text, "hello")  # not JSON, not cached
+
+            other = os.path.join(directory, "settings.json")
+            xenoslib.atomic_write(other, "{}")
+            Api.response_cache.clear()
+            self.assertEqual(os.listdir(directory), ["settings.json"])
+            self.assertEqual(len(Api.response_cache), 0)
+
+    def graph_batch(self, handler):
+        """Answer a Graph JSON batch, throttling "busy" once, failing "missing"."""
+        self.batches.append(json.loads(handler.body)["requests"])
+        statuses, responses = {}, []
+        for request in self.batches[-1]:
+            name = request["url"].split("?")[0].rsplit("/", 1)[1]
+            status, headers = 200, {}
+            body = {"name": name, "method": request["method"], "body": request.get("body")}
+            if any(statuses[id] >= 400 for id in request.get("dependsOn", ())):
+                status, body = 424, {"error": {"code": "failedDependency"}}
+            elif name == "missing":
+                status, body = 404, {"error": {"code": "itemNotFound"}}
+            elif name == "note":  # text, which happens to be valid base64 too
+                headers, body = {"Content-Type": "text/plain"}, "Zm9v"
+            elif name == "blob":
+                headers, body = {"Content-Type": "application/octet-stream"}, "AAE="
+            elif name == "busy" and name not in self.throttled:
+                self.throttled.add(name)
+                status, headers, body = 429, {"Retry-After": "0"}, None
+            statuses[request["id"]] = status
+            response = {"id": request["id"], "status": status, "headers": headers, "body": body}
+            responses.append(response)
+        return 200, {}, {"responses": responses[::-1]}
+
+    def test_batch(self):
+        self.batches, self.throttled = [], set()
+        self.server.routes[("POST", "/v1.0/$batch")] = self.graph_batch
+
+        class Graph(xenoslib.onedrive.OneDrive):
+            base_url = f"{self.server.url}/v1.0"
+            retry_policy = RetryPolicy(sleep=lambda seconds: None)
+
+        one = Graph()
+        with one.batch():
+            items = [one.get_path(f"item{i}") for i in range(45)]
+            renamed = one.rename("item0", "new")
+        self.assertEqual([len(batch) for batch in self.batches], [20, 20, 6])
+        names = [item.result()["name"] for item in items]
+        self.assertEqual(names, [f"item{i}" for i in range(45)])
+        self.assertEqual(renamed.result()["body"], {"name": "new", "parentReference": {}})
+        with one.batch(sequential=True):
+            missing = one.get_path("missing")
+            after = one.get_path("after")
+        self.assertEqual(missing.exception().response.status_code, 404)
+        self.assertEqual(after.exception().response.status_code, 424)
+        with one.batch():
+            busy = one.get_path("busy")
+            waiting = one.get("/me/drive/root:/waiting", params={"a": 1}, depends_on=[busy])
+        self.assertEqual(self.batches[-1][1]["url"], "/me/drive/root:/waiting?a=1")
+        self.assertEqual(self.batches[-1][1]["dependsOn"], ["1"])
+        self.assertEqual((busy.result()["name"], waiting.result()["name"]), ("busy", "waiting"))
+        self.assertEqual(len(self.batches), 6)  # resent once after the 429
+        with one.batch():
+            note, blob = one.get_path("note"), one.get_path("blob")
+        self.assertEqual(note.result().text, "Zm9v")
+        self.assertEqual(blob.result().content, b"\x00\x01")
+        with self.assertRaises(RuntimeError), one.batch():
+            cancelled = one.get_path("item0")
+            raise RuntimeError
+        self.assertTrue(cancelled.cancelled())
+        self.assertEqual(len(self.batches), 7)
+        with self.assertRaises(TypeError), RequestAdapter().batch():
+            pass
+
+    def test_token_bucket(self):
+        now, sleeps = [0], []
+        bucket = TokenBucket(2, capacity=2, timer=lambda: now[0], sleep=sleeps.append)
+        self.assertEqual([bucket.acquire() for _ in range(4)], [0, 0, 0.5, 1])
+        now[0] = 3  # the bucket refilled, up to its capacity
+        self.assertEqual([bucket.acquire() for _ in range(3)], [0, 0, 0.5])
+        bucket.pause(10)
+        self.assertEqual(bucket.acquire(), 11)
+        self.assertEqual(sleeps, [0.5, 1, 0.5, 11])
+
+    @unittest.skipUnless(importlib.util.find_spec("aiohttp"), "needs aiohttp")
+    def test_async(self):
+        class Api(AsyncRequestAdapter):
+            base_url = self.server.url
+
+        async def main():
+            async with Api(limit_per_host=4) as api:
+                items = await asyncio.gather(
+                    *(api.get("item", params={"id": i}) for i in range(12))
+                )
+                text = await api.get("text")
+                with self.assertRaises(Exception):
+                    await api.get("error")
+                return items, text
+
+        items, text = asyncio.run(main())
+        self.assertEqual(items, [{"id": str(i)} for i in range(12)])
+        self.assertEqual(self.max_active, 4)
+        self.assertEqual(text.status, 200)
+
 
 class TestNestedData(unittest.TestCase):
     def setUp(self):
@@ -112,6 +833,230 @@ class TestNestedData(unittest.TestCase):
         result = nd.find_keyvalue("c", 2)
         self.assertEqual(result, {"c": 2, "d": [3, 4, {"e": 5}]})
 
+    def test_deep_data(self):
+        data = leaf = {}
+        for _ in range(10000):
+            leaf["n"] = [{}]
+            leaf = leaf["n"][0]
+        leaf["e"] = 5
+        for nd in (NestedData(data), NestedData(data, index=True)):
+            self.assertEqual(nd.find_key("e"), 5)
+            self.assertEqual(nd.path, "['n'][0]" * 10000 + "['e']")
+            self.assertEqual(nd.get_path(nd.path), 5)
+            nd.set_path(nd.path, 6)
+            self.assertEqual(nd.find_key("e"), 6)
+            nd.delete_path(nd.path)
+            self.assertIsNone(nd.find_key("e"))
+            leaf["e"] = 5
+
+    def test_query(self):
+        nd = NestedData(self.data)
+        self.assertEqual(list(nd.query("$.b.d[*].e")), [({"e": 5}, "['b']['d'][2]['e']")])
+        self.assertEqual(list(nd.query("**.g")), list(nd.find_keys("g")))
+        self.assertEqual(list(nd.query("$..e")), list(nd.find_keys("e")))
+        self.assertEqual(nd.query("$.f[-1]['g']").__next__(), ({"g": 8}, "['f'][2]['g']"))
+        paths = [path for obj, path in nd.query("b.*")]
+        self.assertEqual(paths, ["['b']['c']", "['b']['d']"])
+        self.assertEqual(list(nd.query("$.x.y")), [])
+        self.assertRaises(ValueError, nd.query, "$.b[")
+
+    def test_find_many(self):
+        data = {"c": {"c": 1, "e": 5}, "b": self.data["b"]}
+        for nd in (NestedData(data), NestedData(data, index=True)):
+            results = nd.find_many(keys=["c", "x"], values=[5], keyvalues=[("e", 5)])
+            self.assertEqual(results["keys"]["c"], next(nd.find_keys("c")))
+            self.assertIsNone(results["keys"]["x"])
+            self.assertEqual(results["values"][5], ({"c": 1, "e": 5}, "['c']['e']"))
+            self.assertEqual(results["keyvalues"][("e", 5)], results["values"][5])
+            results = nd.find_many(keys=["c"], values=[5], first=False)
+            self.assertEqual(results["keys"]["c"], list(nd.find_keys("c")))
+            self.assertEqual(results["values"][5], list(nd.find_values(5)))
+            results = nd.find_many(keys=["e"], values=["e"])  # the same pattern in two kinds
+            self.assertEqual(results["keys"]["e"], next(nd.find_keys("e")))
+            self.assertIsNone(results["values"]["e"])
+
+    def test_path_access(self):
+        nd = NestedData(self.data, index=True)
+        nd.find_value(5)
+        self.assertEqual(nd.get_path(nd.path), 5)
+        self.assertEqual(nd.get_path(("f", 2, "g")), 8)
+        self.assertEqual(nd.get_path(""), self.data)
+        nd.set_path("['b']['d'][2]['e']", 6)
+        self.assertEqual(nd.find_key("e"), 6)
+        nd.delete_path("['b']['c']")
+        self.assertIsNone(nd.find_key("c"))
+        self.assertRaises(KeyError, nd.get_path, "['b']['c']")
+        self.assertRaises(ValueError, nd.get_path, "['b'][len('c')]")
+        self.assertRaises(ValueError, nd.get_path, "['b'];x")
+        self.assertRaises(ValueError, nd.delete_path, "")
+
+    def test_search_many(self):
+        documents = [{"id": i, "sub": [{"id": i + 1}]} for i in range(100)]
+        expected = [list(NestedData(document).find(is_even_id)) for document in documents]
+        for executor in ("thread", "process"):
+            results = NestedData.search_many(
+                iter(documents), is_even_id, workers=2, executor=executor, chunksize=7
+            )
+            self.assertEqual(list(results), expected)
+        results = NestedData.search_many(documents, lambda k, v: v == 3, executor="thread")
+        self.assertEqual(sum(len(matches) for matches in results), 2)
+
+    def test_interleaved_finds(self):
+        nd = NestedData(self.data)
+        keys, values = nd.find_keys("c"), nd.find_values(5)
+        self.assertEqual(next(keys)[1], "['b']['c']")
+        self.assertEqual(next(values)[1], "['b']['d'][2]['e']")
+
+
+class TestNestedDataIndex(unittest.TestCase):
+    def setUp(self):
+        self.data = {
+            "a": 1,
+            "b": {"c": 2, "d": [3, 4, {"e": 5, "c": {"c": 2}}]},
+            "f": (6, 7, {"g": 8, 5: "c"}),
+        }
+
+    def test_same_as_traversal(self):
+        plain = NestedData(self.data)
+        indexed = NestedData(self.data, index=True)
+        queries = [
+            ("find_keys", ("c",)),
+            ("find_keys", (0,)),
+            ("find_values", (2,)),
+            ("find_values", ({"c": 2},)),
+            ("find_keyvalues", ("c", 2)),
+            ("find_any_keyvalues", ("c",)),
+            ("find_any_keyvalues", (5,)),
+        ]
+        for method, args in queries:
+            self.assertEqual(
+                list(getattr(indexed, method)(*args)), list(getattr(plain, method)(*args))
+            )
+        self.assertEqual(indexed.find_key("g"), 8)
+        self.assertEqual(indexed.path, "['f'][2]['g']")
+        self.assertEqual(indexed.find_any(5), {"e": 5, "c": {"c": 2}})
+
+    def test_diff(self):
+        nd = NestedData(self.data, index=True)
+        new = copy.deepcopy(self.data)
+        new["a"] = 2
+        new["b"]["d"].append({"c": 3})
+        del new["b"]["d"][2]["e"]
+        new["h"] = {"c": 4}
+        changes = list(nd.diff(new))
+        expected = [
+            ("changed", "['a']", 1, 2),
+            ("removed", "['b']['d'][2]['e']", 5, None),
+            ("added", "['b']['d'][3]", None, {"c": 3}),
+            ("added", "['h']", None, {"c": 4}),
+        ]
+        self.assertEqual(changes, expected)
+        index = nd._index
+        nd.apply_diff(changes)
+        self.assertIs(nd._index, index)
+        self.assertEqual(nd.data, new)
+        self.assertEqual(list(nd.diff(new)), [])
+        plain = NestedData(new)
+        self.assertEqual(list(nd.find_keys("c")), list(plain.find_keys("c")))
+        self.assertEqual(list(nd.find_values(5)), [])
+        self.assertEqual(nd.find_keyvalue("c", 4), {"c": 4})
+
+    def test_diff_deep(self):
+        def deep(leaf_value):
+            data = leaf = {}
+            for _ in range(10000):
+                leaf["n"] = [{}]
+                leaf = leaf["n"][0]
+            leaf["e"] = leaf_value
+            return data
+
+        nd = NestedData(deep(5))
+        self.assertEqual(list(nd.diff(deep(5))), [])
+        path = "['n'][0]" * 10000 + "['e']"
+        self.assertEqual(list(nd.diff(deep(6))), [("changed", path, 5, 6)])
+
+    def test_reindex(self):
+        nd = NestedData(self.data, index=True)
+        self.assertIsNone(nd.find_key("h"))
+        self.data["b"]["h"] = 9
+        self.assertIsNone(nd.find_key("h"))  # stale until reindexed
+        nd.reindex()
+        self.assertEqual(nd.find_key("h"), 9)
+        self.data["b"]["i"] = 10
+        nd.invalidate_index()
+        self.assertEqual(nd.find_key("i"), 10)
+        nd.data = {"j": 11}
+        self.assertEqual(nd.find_key("j"), 11)
+
+
+class TestMappedNestedData(unittest.TestCase):
+    def setUp(self):
+        self.data = {
+            "a": 1,
+            "b": {"c": 2.5, "d": [3, -4, {"e": '\u00e9"\\', "c": None}], "x": [], "y": {}},
+            "f": [True, {}, {"g": [1, [2, {"c": {"c": 1}}]]}],
+        }
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as w:
+            json.dump(self.data, w, indent=1)
+        self.addCleanup(os.remove, w.name)
+        self.mapped = NestedData.from_mmap(w.name)
+        self.addCleanup(self.mapped.close)
+
+    def test_same_as_loaded(self):
+        plain = NestedData(self.data)
+        queries = [
+            ("find_keys", ("c",)),
+            ("find_keys", (1,)),
+            ("find_values", (1,)),
+            ("find_values", ('\u00e9"\\',)),
+            ("find_values", ({"c": 1},)),
+            ("find_keyvalues", ("c", None)),
+            ("find_any_keyvalues", ("c",)),
+        ]
+        for method, args in queries:
+            self.assertEqual(
+                list(getattr(self.mapped, method)(*args)), list(getattr(plain, method)(*args))
+            )
+        self.assertEqual(self.mapped.find_key("g"), self.data["f"][2]["g"])
+        self.assertEqual(self.mapped.path, "['f'][2]['g']")
+        self.assertEqual(self.mapped.data, self.data)
+
+
+class TestNestedStream(unittest.TestCase):
+    def setUp(self):
+        self.data = {
+            "a": 1,
+            "b": {"c": 2.5, "d": [3, -4, {"e": "\u00e9'", "c": None}], "x": []},
+            "f": [True, {}, {"g": 8}],
+        }
+
+    def test_json(self):
+        text = json.dumps(self.data)
+        for fileobj in (io.StringIO(text), io.BytesIO(text.encode())):
+            stream = NestedStream(fileobj, chunk_size=3)
+            expected = [(2.5, "['b']['c']"), (None, "['b']['d'][2]['c']")]
+            self.assertEqual(list(stream.find_keys("c")), expected)
+            self.assertEqual(list(stream.find_values(8)), [(8, "['f'][2]['g']")])
+            expected = [("\u00e9'", "['b']['d'][2]['e']")]
+            self.assertEqual(list(stream.find_keyvalues("e", "\u00e9'")), expected)
+            self.assertEqual(stream.find_key("d"), self.data["b"]["d"])
+            self.assertEqual(stream.path, "['b']['d']")
+
+    def test_big_int(self):
+        fileobj = io.BytesIO(b'{"a": [123456789012345678901234567890]}')
+        stream = NestedStream(fileobj)  # not ijson by default, which overflows
+        self.assertEqual(stream.find_key("a"), [123456789012345678901234567890])
+
+    def test_yaml(self):
+        stream = NestedData.from_stream(io.StringIO(yaml.safe_dump(self.data)), format="yaml")
+        self.assertEqual(list(stream.find_values(-4)), [(-4, "['b']['d'][1]")])
+        self.assertEqual(stream.find_key("f"), self.data["f"])
+
+    def test_invalid(self):
+        for text in ('{"a": 1,}', "[1 2]", '{"a": [1}'):
+            self.assertRaises(ValueError, list, NestedStream(io.StringIO(text)).find_keys("a"))
+        self.assertRaises(TypeError, list, NestedStream(io.StringIO("{}")).find_values([1]))
+
 
 if __name__ == "__main__":
     unittest.main()  # run all unit tests
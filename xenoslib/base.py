@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import argparse
+import ast
+import codecs
+import functools
+import heapq
+import itertools
+import re
 import sys
 import time
 import inspect
+import json
 import logging
+import mmap
 import os
 
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from json import JSONDecodeError
+from json.decoder import scanstring
+from json.scanner import NUMBER_RE
 from logging.handlers import TimedRotatingFileHandler
 
 
@@ -107,39 +121,121 @@ class NestedData:
     The class maintains state through its result and path attributes, which are updated every time a
     result is found by one of the find() methods.
 
+    With index=True an inverted index from keys and hashable values to their containers is built
+    on first use, so find_keys(), find_values(), find_keyvalues() and find_any() become hash lookups
+    instead of walking the whole structure. Assigning a new data invalidates the index, while
+    set_path(), delete_path() and apply_diff() update it in place. After mutating data in place
+    otherwise call reindex() or invalidate_index().
+
     :param data: The data structure to search.
+    :param index: If True, answer lookups from an inverted index instead of traversal.
     """
 
-    def __init__(self, data):
+    def __init__(self, data, index=False):
         self.data = data
         self.result = None  # The most recently found result.
         self.path = None  # The path to the most recently found result.
         self._condition = None  # The condition function used by the find() method.
+        self._use_index = index
+
+    @classmethod
+    def from_stream(cls, fileobj, format="json"):
+        """
+        Search a JSON or YAML document while reading it, instead of loading it into memory.
+
+        :param fileobj: A file object opened in text or binary mode.
+        :param format: "json" or "yaml".
+        :return: A NestedStream with find_keys(), find_values() and find_keyvalues().
+        """
+        return NestedStream(fileobj, format=format)
+
+    @classmethod
+    def from_mmap(cls, filepath):
+        """
+        Search a JSON file through a memory map and a compact index instead of loading it.
+
+        :param filepath: The path of the JSON file.
+        :return: A MappedNestedData.
+        """
+        return MappedNestedData(filepath)
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._index = None
+
+    def reindex(self):
+        """
+        Build the inverted index over the current data, replacing any existing one.
+
+        :return: The new index.
+        """
+        self._index = _NestedIndex(self.data)
+        return self._index
+
+    def invalidate_index(self):
+        """
+        Drop the inverted index, it will be rebuilt by the next indexed lookup.
+        """
+        self._index = None
+
+    def _indexed(self, var):
+        """
+        Get the inverted index if it is enabled and var can be looked up in it.
 
-    def _find(self, obj, path=""):
+        :param var: The key or value to look up.
+        :return: The index, or None if the lookup has to traverse the data.
+        """
+        if not self._use_index:
+            return None
+        try:
+            hash(var)
+        except TypeError:
+            return None
+        if self._index is None:
+            self.reindex()
+        return self._index
+
+    def _find(self, obj, condition, ignore_exc=False):
         """
-        Recursively search the nested data structure for elements that match the condition function.
+        Search the nested data structure for elements that match the condition function.
+
+        The structure is walked depth first with an explicit stack, so deep documents do not hit the
+        recursion limit. The path is kept as a list of keys and only formatted for yielded results.
 
         :param obj: The object to search.
-        :param path: The path to the object.
+        :param condition: The condition function.
+        :param ignore_exc: If True, ignore any exceptions raised by the condition function.
         :yield: A generator that yields tuples of the object and its path.
         """
-        if isinstance(obj, dict):
-            iter_obj = obj.items()
-        elif isinstance(obj, (list, tuple)):
-            iter_obj = enumerate(obj)
-        else:
+        items = _iter_items(obj)
+        if items is None:
             return
-        for k, v in iter_obj:
-            new_path = f"{path}[{repr(k)}]"
-            try:
-                if self._condition(k, v):
-                    yield obj, new_path
-                    continue
-            except Exception as exc:
-                if not self.ignore_exc:
-                    raise exc
-            yield from self._find(v, new_path)
+        keys = []
+        stack = [(obj, items)]
+        while stack:
+            container, items = stack[-1]
+            for k, v in items:
+                try:
+                    if condition(k, v):
+                        yield container, _format_path(keys + [k])
+                        continue
+                except Exception as exc:
+                    if not ignore_exc:
+                        raise exc
+                children = _iter_items(v)
+                if children is not None:
+                    keys.append(k)
+                    stack.append((v, children))
+                    break
+            else:
+                stack.pop()
+                if stack:
+                    keys.pop()
 
     def find(self, condition, ignore_exc=False):
         """
@@ -151,7 +247,98 @@ class NestedData:
         """
         self.ignore_exc = ignore_exc
         self._condition = condition
-        return self._find(self.data)
+        return self._find(self.data, condition, ignore_exc)
+
+    def query(self, expr):
+        """
+        Find all elements matching a JSONPath / glob style path expression.
+
+        Supported syntax: "$" for the root (optional), ".name" or "['name']" for a dict key, "[0]"
+        and "[-1]" for a list index, "*" or "[*]" for any child and "**" or ".." for any depth, e.g.
+        "$.b.d[*].e", "$..id" or "**.id". Subtrees that can not match are not walked, and a literal
+        step is a direct lookup. Compiled expressions are cached.
+
+        :param expr: The path expression.
+        :return: A generator that yields tuples of the object and its path, like find().
+        """
+        return self._query(self.data, _compile_query(expr))
+
+    def _query(self, obj, steps):
+        """
+        Walk the nested data structure following the compiled steps of a path expression.
+
+        Each container is visited with the set of steps still to match, a child continues with the
+        steps it matched, is yielded when it completes the expression and is not walked when nothing
+        is left to match below it.
+
+        :param obj: The object to search.
+        :param steps: The compiled path expression.
+        :yield: A generator that yields tuples of the object and its path.
+        """
+        end = len(steps)
+        states = _query_closure(steps, (0,))
+        items = _query_items(obj, steps, states)
+        if items is None:
+            return
+        keys = []
+        stack = [(obj, items, states)]
+        while stack:
+            container, items, states = stack[-1]
+            for k, v in items:
+                matched = _query_advance(steps, states, container, k)
+                if not matched:
+                    continue
+                if end in matched:
+                    yield container, _format_path(keys + [k])
+                    if len(matched) == 1:
+                        continue
+                children = _query_items(v, steps, matched)
+                if children is not None:
+                    keys.append(k)
+                    stack.append((v, children, matched))
+                    break
+            else:
+                stack.pop()
+                if stack:
+                    keys.pop()
+
+    @classmethod
+    def search_many(
+        cls, documents, condition, workers=None, executor="process", chunksize=64, ignore_exc=False
+    ):
+        """
+        Run find() with the same condition over many documents in parallel.
+
+        Documents are sent to the workers in chunks, and at most two chunks per worker are in flight,
+        so a large or endless iterable of documents is not read ahead without limit. Results come
+        back in input order. With executor="process" the condition must be picklable, e.g. a module
+        level function rather than a lambda, and the yielded containers are copies.
+
+        :param documents: An iterable of documents.
+        :param condition: The condition function.
+        :param workers: The number of workers, defaults to the number of CPUs.
+        :param executor: "process" or "thread".
+        :param chunksize: The number of documents sent to a worker at a time.
+        :param ignore_exc: If True, ignore any exceptions raised by the condition function.
+        :return: A generator that yields, for every document, a list of tuples of the object and its
+            path.
+        """
+        executors = {"process": ProcessPoolExecutor, "thread": ThreadPoolExecutor}
+        if executor not in executors:
+            raise ValueError(f"Unsupported executor: {executor!r}")
+        workers = workers or os.cpu_count() or 1
+        documents = iter(documents)
+        with executors[executor](max_workers=workers) as pool:
+            pending = deque()
+            while True:
+                while len(pending) < 2 * workers:
+                    chunk = list(itertools.islice(documents, chunksize))
+                    if not chunk:
+                        break
+                    pending.append(pool.submit(_search_chunk, cls, chunk, condition, ignore_exc))
+                if not pending:
+                    return
+                yield from pending.popleft().result()
 
     def _find_one(self, method, *args, **kwagrs):
         """
@@ -177,6 +364,9 @@ class NestedData:
         :param key: The key to search for.
         :return: A generator that yields tuples of the object and its path.
         """
+        index = self._indexed(key)
+        if index is not None:
+            return index.find_keys(key)
         return self.find(lambda k, v: k == key)
 
     def find_values(self, value):
@@ -189,6 +379,9 @@ class NestedData:
         Returns:
             A list of tuples containing the matched values and their corresponding paths.
         """
+        index = self._indexed(value)
+        if index is not None:
+            return index.find_values(value)
         return self.find(lambda k, v: v == value)
 
     def find_keyvalues(self, key, value):
@@ -202,6 +395,9 @@ class NestedData:
         Returns:
             A list of tuples containing the matched key-value pairs and their corresponding paths.
         """
+        index = self._indexed(key)
+        if index is not None:
+            return index.find_keyvalues(key, value)
         return self.find(lambda k, v: (k, v) == (key, value))
 
     def find_any_keyvalues(self, var):
@@ -214,6 +410,9 @@ class NestedData:
         Returns:
             A list of tuples containing the matched keys or values and their corresponding paths.
         """
+        index = self._indexed(var)
+        if index is not None:
+            return index.find_any_keyvalues(var)
         return self.find(lambda k, v: var in (k, v), ignore_exc=True)
 
     def find_any(self, var):
@@ -270,6 +469,199 @@ class NestedData:
         """
         return self._find_one(self.find_keyvalues, key, value)
 
+    def find_many(self, keys=(), values=(), keyvalues=(), first=True):
+        """
+        Find several keys, values and key-value pairs with a single traversal.
+
+        Each pattern is matched the same way as by find_keys(), find_values() and find_keyvalues(),
+        so K lookups cost one walk instead of K. With first=True the walk stops as soon as every
+        pattern has been found. Patterns must be hashable.
+
+        Args:
+            keys: The keys to search for.
+            values: The values to search for.
+            keyvalues: The (key, value) pairs to search for.
+            first: If True, map each pattern to its first match only.
+
+        Returns:
+            A dict with the "keys", "values" and "keyvalues" results, each a dict from the patterns
+            to a tuple of the matched object and its path, None if not found, or with first=False
+            to a list of all such tuples.
+        """
+        patterns = {
+            "keys": list(dict.fromkeys(keys)),
+            "values": list(dict.fromkeys(values)),
+            "keyvalues": list(dict.fromkeys(tuple(keyvalue) for keyvalue in keyvalues)),
+        }
+        if self._use_index:
+            return self._find_many_indexed(patterns, first)
+        return self._find_many_walk(patterns, first)
+
+    def _find_many_indexed(self, patterns, first):
+        """Look up every pattern of find_many() in the inverted index."""
+        methods = {
+            "keys": self.find_keys,
+            "values": self.find_values,
+            "keyvalues": lambda keyvalue: self.find_keyvalues(*keyvalue),
+        }
+        results = {}
+        for kind, kind_patterns in patterns.items():
+            results[kind] = {}
+            for pattern in kind_patterns:
+                matches = methods[kind](pattern)
+                results[kind][pattern] = next(matches, None) if first else list(matches)
+        return results
+
+    def _find_many_walk(self, patterns, first):
+        """Match every pattern of find_many() in one walk of the data."""
+        results = {
+            kind: {pattern: None if first else [] for pattern in kind_patterns}
+            for kind, kind_patterns in patterns.items()
+        }
+        remaining = sum(len(kind_patterns) for kind_patterns in patterns.values())
+        matcher = _PatternMatcher(patterns, first)
+        for container, k, v, path in _iter_nodes(self.data):
+            found = matcher.match(k, v, path)
+            if not found:
+                continue
+            match = container, _format_path(path + [k])
+            for kind, pattern in found:
+                if not first:
+                    results[kind][pattern].append(match)
+                elif results[kind][pattern] is None:
+                    results[kind][pattern] = match
+                    remaining -= 1
+            if first and not remaining:
+                break
+        return results
+
+    def get_path(self, path):
+        """
+        Get the element at a path as returned by the find() methods, e.g. "['b']['d'][2]['e']".
+
+        Path strings are parsed once and cached, so reading the same paths again across many
+        documents costs neither a search nor a parse.
+
+        :param path: A path string, or a sequence of keys.
+        :return: The element at the path, KeyError or IndexError is raised if it does not exist.
+        """
+        obj = self.data
+        for key in _path_keys(path):
+            obj = obj[key]
+        return obj
+
+    def set_path(self, path, value):
+        """
+        Set the element at a path, replacing the whole data for an empty path.
+
+        Setting the index just past the end of a list appends to it. The index of an indexed
+        instance is updated for the changed subtree only.
+
+        :param path: A path string, or a sequence of keys.
+        :param value: The value to set.
+        """
+        keys = _path_keys(path)
+        if not keys:
+            self.data = value
+            return
+        container = self.get_path(keys[:-1])
+        key = keys[-1]
+        if isinstance(container, list) and isinstance(key, int) and key < 0:
+            key += len(container)
+        if isinstance(container, list) and key == len(container):
+            old = _MISSING
+            container.append(value)
+        else:
+            old = container.get(key, _MISSING) if isinstance(container, dict) else container[key]
+            container[key] = value
+        index = self._index
+        if index is None:
+            return
+        try:
+            if old is _MISSING:
+                index.add(container, key, value, index.node(keys[:-1]))
+            else:
+                index.replace(index.node(keys[:-1] + (key,)), old, value)
+        except KeyError:  # the index is out of date with the data
+            self.invalidate_index()
+
+    def delete_path(self, path):
+        """
+        Delete the element at a path.
+
+        The index of an indexed instance is updated for the removed subtree only, unless an item
+        before the end of a list is deleted, which invalidates the index.
+
+        :param path: A path string, or a sequence of keys.
+        """
+        keys = _path_keys(path)
+        if not keys:
+            raise ValueError("The root of the data can not be deleted")
+        container = self.get_path(keys[:-1])
+        key = keys[-1]
+        if isinstance(container, list) and isinstance(key, int) and key < 0:
+            key += len(container)
+        old = container[key]
+        del container[key]
+        index = self._index
+        if index is None:
+            return
+        if isinstance(container, list) and key != len(container):
+            self.invalidate_index()  # the following items moved to other indexes
+            return
+        try:
+            index.remove(index.node(keys[:-1] + (key,)), old)
+        except KeyError:  # the index is out of date with the data
+            self.invalidate_index()
+
+    def diff(self, other):
+        """
+        Compare the data with other data and yield the differences.
+
+        Subtrees that are the same object are skipped without walking them, others are walked with
+        an explicit stack, so deep documents do not hit the recursion limit. Dicts are compared by key
+        and lists by index, any other difference, including a change of type or of a tuple, is
+        reported as a change of the whole value.
+
+        :param other: The other data, or a NestedData.
+        :return: A generator that yields tuples of (change, path, old, new), where change is
+            "added", "removed" or "changed" and a missing old or new value is None.
+        """
+        if isinstance(other, NestedData):
+            other = other.data
+        if self.data is other:
+            return
+        stack = [((), self.data, other)]
+        while stack:
+            entry = stack.pop()
+            if len(entry) == 4:
+                yield entry
+                continue
+            keys, old, new = entry
+            pairs = _diff_pairs(old, new)
+            if pairs is not None:
+                stack.extend(reversed(_diff_children(keys, pairs)))
+            elif old != new:
+                yield "changed", _format_path(keys), old, new
+
+    def apply_diff(self, changes):
+        """
+        Apply changes yielded by diff() to the data in place, so that it equals the other data.
+
+        The index of an indexed instance is updated for the changed subtrees only instead of being
+        rebuilt.
+
+        :param changes: The changes yielded by diff().
+        """
+        removed = []
+        for change, path, old, new in list(changes):
+            if change == "removed":
+                removed.append(path)
+            else:
+                self.set_path(path, new)
+        for path in reversed(removed):  # list items are removed from the end
+            self.delete_path(path)
+
     def show_result(self):
         """
         Print the most recently found result and its corresponding path.
@@ -280,6 +672,1149 @@ class NestedData:
         print(self.path)
 
 
+_MISSING = object()
+
+
+def _diff_pairs(old, new):
+    """Get the (key, old value, new value) of the children of two dicts or two lists, else None."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        pairs = [(k, v, new.get(k, _MISSING)) for k, v in old.items()]
+        return pairs + [(k, _MISSING, v) for k, v in new.items() if k not in old]
+    if isinstance(old, list) and isinstance(new, list):
+        pairs = itertools.zip_longest(old, new, fillvalue=_MISSING)
+        return [(i, *pair) for i, pair in enumerate(pairs)]
+    return None
+
+
+def _diff_children(keys, pairs):
+    """
+    Turn the children of a container into changes, or into entries to compare for NestedData.diff().
+    """
+    children = []
+    for k, old_value, new_value in pairs:
+        if old_value is new_value:
+            continue
+        path = keys + (k,)
+        if new_value is _MISSING:
+            children.append(("removed", _format_path(path), old_value, None))
+        elif old_value is _MISSING:
+            children.append(("added", _format_path(path), None, new_value))
+        else:
+            children.append((path, old_value, new_value))
+    return children
+
+
+def _iter_items(obj):
+    """Iterate the (key, value) pairs of a dict, list or tuple, return None for other objects."""
+    if isinstance(obj, dict):
+        return iter(obj.items())
+    if isinstance(obj, (list, tuple)):
+        return enumerate(obj)
+    return None
+
+
+def _search_chunk(cls, documents, condition, ignore_exc):
+    """Search a chunk of documents for NestedData.search_many(), runs in a worker."""
+    return [list(cls(document).find(condition, ignore_exc)) for document in documents]
+
+
+def _iter_nodes(obj):
+    """
+    Walk a nested data structure depth first and yield every (container, key, value, path).
+
+    path is the list of keys leading to the container, it is updated in place during the walk.
+    """
+    items = _iter_items(obj)
+    if items is None:
+        return
+    path = []
+    stack = [(obj, items)]
+    while stack:
+        container, items = stack[-1]
+        for k, v in items:
+            yield container, k, v, path
+            children = _iter_items(v)
+            if children is not None:
+                path.append(k)
+                stack.append((v, children))
+                break
+        else:
+            stack.pop()
+            if stack:
+                path.pop()
+
+
+def _format_path(keys):
+    """Format a sequence of keys as the path string used by NestedData, e.g. "['b']['d'][2]"."""
+    return "".join(f"[{k!r}]" for k in keys)
+
+
+_PATH_KEY = re.compile(
+    r"""\[\s*(
+        [bBrRuU]{0,2}'(?:[^'\\]|\\.)*'
+        | [bBrRuU]{0,2}"(?:[^"\\]|\\.)*"
+        | \((?:[^()'"]|'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")*\)
+        | [^\[\]'"()]+
+    )\s*\]""",
+    re.VERBOSE | re.DOTALL,
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_path(path):
+    """
+    Parse a path string such as "['b']['d'][2]" into a tuple of keys, the keys are literals.
+
+    The path is split with a regular expression and only each key is evaluated, so the length of
+    the path is not limited by the recursion limit.
+    """
+    keys = []
+    pos = 0
+    while pos < len(path):
+        match = _PATH_KEY.match(path, pos)
+        if match is None:
+            raise ValueError(f"Invalid path: {path!r}")
+        try:
+            keys.append(ast.literal_eval(match.group(1).strip()))
+        except (ValueError, SyntaxError) as exc:
+            raise ValueError(f"Invalid path: {path!r}") from exc
+        pos = match.end()
+    return tuple(keys)
+
+
+def _path_keys(path):
+    """Get the keys of a path string or of a sequence of keys."""
+    if isinstance(path, str):
+        return _parse_path(path)
+    return tuple(path)
+
+
+_QUERY_TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<deep>\*\*|\.\.)
+        | (?P<dot>\.)
+        | (?P<any>\*|\[\s*\*\s*\])
+        | \[\s*(?:(?P<index>-?\d+)|'(?P<squote>(?:[^'\\]|\\.)*)'|"(?P<dquote>(?:[^"\\]|\\.)*)")\s*\]
+        | (?P<name>[^.\[\]*\s]+)
+    )""",
+    re.VERBOSE,
+)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_query(expr):
+    """
+    Compile a path expression for NestedData.query() into a tuple of (kind, key) steps.
+
+    kind is "key" for a literal dict key or list index, "any" for any child and "deep" for any
+    number of levels.
+    """
+    steps = []
+    pos = 0
+    text = expr.strip()
+    if text.startswith("$"):
+        pos = 1
+    while pos < len(text):
+        match = _QUERY_TOKEN.match(text, pos)
+        if match is None or match.end() == pos:
+            raise ValueError(f"Invalid query expression {expr!r} at position {pos}")
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == "dot":
+            continue
+        if kind == "deep":
+            if not steps or steps[-1][0] != "deep":
+                steps.append(("deep", None))
+        elif kind == "any":
+            steps.append(("any", None))
+        elif kind == "index":
+            steps.append(("key", int(match.group("index"))))
+        elif kind == "name":
+            steps.append(("key", match.group("name")))
+        else:
+            steps.append(("key", re.sub(r"\\(.)", r"\1", match.group(kind))))
+    return tuple(steps)
+
+
+def _query_closure(steps, states):
+    """Add the steps following "deep" steps, as those also match zero levels."""
+    closure = set(states)
+    for i in states:
+        while i < len(steps) and steps[i][0] == "deep":
+            i += 1
+            closure.add(i)
+    return frozenset(closure)
+
+
+def _query_step_matches(step, container, k):
+    """Check if the key of a child matches a single step, "deep" steps match any key."""
+    kind, key = step
+    return kind in ("any", "deep") or _query_key_matches(container, k, key)
+
+
+def _query_advance(steps, states, container, k):
+    """
+    Get the states of a child from the states of its container.
+
+    A "deep" step stays at the same state, as it can match more levels, other matched steps move on
+    to the next one.
+
+    :return: The states of the child, empty if it matches no step.
+    """
+    matched = [
+        i if steps[i][0] == "deep" else i + 1
+        for i in states
+        if i < len(steps) and _query_step_matches(steps[i], container, k)
+    ]
+    return _query_closure(steps, matched) if matched else frozenset()
+
+
+def _query_key_matches(container, k, key):
+    """Check if the key of a child matches a literal step, negative indexes count from the end."""
+    if isinstance(key, int) and key < 0 and isinstance(container, (list, tuple)):
+        key += len(container)
+    return k == key
+
+
+def _query_items(obj, steps, states):
+    """
+    Iterate the children of obj that the steps can match, None if none can.
+
+    When the steps left are a single literal key the child is looked up directly.
+    """
+    pending = [steps[i] for i in states if i < len(steps)]
+    if not pending:
+        return None
+    if len(pending) > 1 or pending[0][0] != "key":
+        return _iter_items(obj)
+    key = pending[0][1]
+    if isinstance(obj, dict):
+        return iter(((key, obj[key]),)) if key in obj else None
+    if isinstance(obj, (list, tuple)) and isinstance(key, int):
+        if key < 0:
+            key += len(obj)
+        return iter(((key, obj[key]),)) if 0 <= key < len(obj) else None
+    return None
+
+
+class _PatternMatcher:
+    """Match the nodes of a walk against the patterns of NestedData.find_many()."""
+
+    def __init__(self, patterns, first):
+        self.keys = {key: key for key in patterns["keys"]}
+        self.values = {value: value for value in patterns["values"]}
+        self.keyvalues = {}
+        for key, value in patterns["keyvalues"]:
+            self.keyvalues.setdefault(key, []).append((value, (key, value)))
+        self.first = first
+        # key pattern -> depth of its last match, find_keys() skips matches inside
+        self.blocked = {}
+
+    def match(self, k, v, path):
+        """
+        Match a node.
+
+        :return: A list of the (kind, pattern) tuples matched by the node.
+        """
+        depth = len(path)
+        if self.blocked:
+            self.blocked = {key: d for key, d in self.blocked.items() if depth > d}
+        found = []
+        key = self.keys.get(k, _MISSING)
+        if key is not _MISSING and key not in self.blocked:
+            found.append(("keys", key))
+            if not self.first:
+                self.blocked[key] = depth
+        try:
+            value = self.values.get(v, _MISSING)
+        except TypeError:  # unhashable values do not equal hashable patterns
+            value = _MISSING
+        if value is not _MISSING:
+            found.append(("values", value))
+        pairs = self.keyvalues.get(k, ())
+        found.extend(("keyvalues", pattern) for value, pattern in pairs if v == value)
+        return found
+
+
+class _IndexNode:
+    """A key/value pair of a container in a _NestedIndex."""
+
+    __slots__ = ("container", "key", "parent", "order", "value")
+
+    def __init__(self, container, key, parent, order, value):
+        self.container = container
+        self.key = key
+        self.parent = parent  # The node of the container, None at the top level.
+        self.order = order  # Increases in traversal order, later additions sort last.
+        self.value = value  # The value if it is hashable, otherwise _MISSING.
+
+
+class _NestedIndex:
+    """
+    Inverted index of a nested data structure used by NestedData(data, index=True).
+
+    Every key/value pair of every dict, list and tuple is an _IndexNode. Nodes are kept by key and
+    by hashable value in insertion ordered buckets, sorted in traversal order, so lookups yield
+    results in the same order as NestedData.find(). Subtrees can be added, replaced and removed in
+    place, the buckets they touch are sorted again on their next lookup.
+    """
+
+    def __init__(self, data):
+        self.keys = {}
+        self.values = {}
+        self.slots = {}  # (parent node, key) -> node
+        self._order = 0
+        self._unsorted = {}  # id(bucket) -> bucket
+        self._add_children(None, data)
+
+    def _bucket_add(self, table, key, node, sort):
+        bucket = table.get(key)
+        if bucket is None:
+            bucket = table[key] = {}
+        bucket[node] = None
+        if sort:
+            self._unsorted[id(bucket)] = bucket
+
+    def _bucket_remove(self, table, key, node):
+        bucket = table[key]
+        del bucket[node]
+        if not bucket:
+            del table[key]
+            self._unsorted.pop(id(bucket), None)
+
+    def _bucket(self, table, key):
+        bucket = table.get(key)
+        if bucket is None:
+            return ()
+        if self._unsorted.pop(id(bucket), None) is not None:
+            nodes = sorted(bucket, key=self._sort_key)
+            bucket.clear()
+            bucket.update(dict.fromkeys(nodes))
+        return bucket
+
+    def _add_children(self, parent, obj, sort=False):
+        items = _iter_items(obj)
+        if items is None:
+            return
+        stack = [(obj, items, parent)]
+        while stack:
+            container, items, parent = stack[-1]
+            for k, v in items:
+                node = _IndexNode(container, k, parent, self._order, _MISSING)
+                self._order += 1
+                self.slots[parent, k] = node
+                self._bucket_add(self.keys, k, node, sort)
+                try:
+                    self._bucket_add(self.values, v, node, sort)
+                    node.value = v
+                except TypeError:
+                    pass  # unhashable values can only be found by traversal
+                children = _iter_items(v)
+                if children is not None:
+                    stack.append((v, children, node))
+                    break
+            else:
+                stack.pop()
+
+    def _remove_children(self, parent, obj):
+        stack = [(obj, parent)]
+        while stack:
+            obj, parent = stack.pop()
+            for k, v in _iter_items(obj) or ():
+                node = self.slots.pop((parent, k))
+                self._bucket_remove(self.keys, k, node)
+                if node.value is not _MISSING:
+                    self._bucket_remove(self.values, node.value, node)
+                stack.append((v, node))
+
+    def node(self, keys):
+        """Get the node at a path of keys, KeyError if it is not indexed."""
+        node = None
+        for key in keys:
+            node = self.slots[node, key]
+        return node
+
+    def add(self, container, key, value, parent):
+        """Index a new key/value pair of a container, parent is the node of the container."""
+        self._add_children(parent, {key: value}, sort=True)
+        node = self.slots[parent, key]
+        node.container = container
+
+    def replace(self, node, old, new):
+        """Index the new value of a node in place of its old value."""
+        self._remove_children(node, old)
+        if node.value is not _MISSING:
+            self._bucket_remove(self.values, node.value, node)
+            node.value = _MISSING
+        try:
+            self._bucket_add(self.values, new, node, sort=True)
+            node.value = new
+        except TypeError:
+            pass
+        self._add_children(node, new, sort=True)
+
+    def remove(self, node, value):
+        """Remove a node and its value from the index."""
+        self._remove_children(node.parent, {node.key: value})
+
+    @staticmethod
+    def _sort_key(node):
+        orders = []
+        while node is not None:
+            orders.append(node.order)
+            node = node.parent
+        return orders[::-1]
+
+    @staticmethod
+    def path(node):
+        """Rebuild the path string of a node from its parents."""
+        keys = []
+        while node is not None:
+            keys.append(node.key)
+            node = node.parent
+        return _format_path(reversed(keys))
+
+    @staticmethod
+    def _under_key(node, key):
+        """Check if an ancestor of the node has the key, find() does not search inside matches."""
+        node = node.parent
+        while node is not None:
+            if node.key == key:
+                return True
+            node = node.parent
+        return False
+
+    def find_keys(self, key):
+        for node in self._bucket(self.keys, key):
+            if not self._under_key(node, key):
+                yield node.container, self.path(node)
+
+    def find_values(self, value):
+        # a value can not equal one of its own containers, so no match is nested in another
+        for node in self._bucket(self.values, value):
+            yield node.container, self.path(node)
+
+    def find_keyvalues(self, key, value):
+        for node in self._bucket(self.keys, key):
+            if node.container[node.key] == value:
+                yield node.container, self.path(node)
+
+    def find_any_keyvalues(self, var):
+        seen = None
+        keys, values = self._bucket(self.keys, var), self._bucket(self.values, var)
+        for node in heapq.merge(keys, values, key=self._sort_key):
+            if node is seen or self._under_key(node, var):
+                continue
+            seen = node
+            yield node.container, self.path(node)
+
+
+class MappedNestedData(NestedData):
+    """
+    NestedData over a memory-mapped JSON file, for read-mostly lookups in huge documents.
+
+    A structural index with the byte offsets of every key and value is built once in array tables,
+    and a value is only decoded into Python objects when a lookup returns it. find_keys(),
+    find_values(), find_keyvalues(), find_any_keyvalues() and the single match methods run on the
+    index, find_key() only decodes the matched value and keeps it as the result. Anything else
+    decodes the whole document into data on first use.
+
+    :param filepath: The path of the JSON file.
+    """
+
+    def __init__(self, filepath):
+        self.result = None  # The most recently found result.
+        self.path = None  # The path to the most recently found result.
+        self._condition = None
+        self._use_index = False
+        self._index = None
+        self._data = None
+        self._root = 0
+        self._last_container = (None, None)
+        with open(filepath, "rb") as r:
+            self._mmap = mmap.mmap(r.fileno(), 0, access=mmap.ACCESS_READ)
+        self._escaped = self._mmap.find(b"\\") != -1
+        self._build()
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._decode(self._root, -1)
+        return self._data
+
+    def close(self):
+        """Close the memory map."""
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _build(self):
+        """
+        Index every key/value pair in traversal order.
+
+        For node i, keys[i] is the offset of its key, or -1 - index in a list, values[i] the offset
+        of its value, parent[i] the node of its container (-1 at the top level) and skip[i] the
+        first node after its subtree. The end of a value is found again from these when needed.
+        """
+        mm = self._mmap
+        nodes = "i" if len(mm) < 2**31 else "q"
+        keys, values, parent, skip = array("q"), array("q"), array(nodes), array(nodes)
+        stack = []
+        top = None  # [node, is_map, items so far, expecting a key] of the innermost container
+        key = 0
+        for match in _JSON_STRUCTURE.finditer(mm):
+            start = match.start()
+            char = mm[start]
+            if char == 0x7D or char == 0x5D:  # } ]
+                node = stack.pop()[0]
+                if node >= 0:
+                    skip[node] = len(skip)
+                top = stack[-1] if stack else None
+                continue
+            if top is None:
+                node = -1
+                self._root = start
+            elif top[3]:
+                key = start
+                top[3] = False
+                continue
+            else:
+                node = len(skip)
+                if top[1]:
+                    keys.append(key)
+                    top[3] = True
+                else:
+                    keys.append(-1 - top[2])
+                    top[2] += 1
+                values.append(start)
+                parent.append(top[0])
+                skip.append(node + 1)
+            if char == 0x7B or char == 0x5B:  # { [
+                top = [node, char == 0x7B, 0, char == 0x7B]
+                stack.append(top)
+        self._keys, self._values, self._parent, self._skip = keys, values, parent, skip
+        if hasattr(mm, "madvise"):  # pages are read from the file again when needed
+            mm.madvise(mmap.MADV_DONTNEED)
+
+    def _end(self, start, node):
+        """Find the end offset of the value at start, node is its node or -1 for the top level."""
+        mm = self._mmap
+        if mm[start] not in b"{[":
+            return _JSON_STRUCTURE.match(mm, start).end()
+        last = (self._skip[node] if node >= 0 else len(self._skip)) - 1
+        pos, closing = start + 1, 1
+        if last != node:
+            # the last node of a subtree is a scalar or an empty container, then each container
+            # up to this one is closed
+            last_start = self._values[last]
+            if mm[last_start] in b"{[":
+                pos, closing = last_start + 1, 2
+            else:
+                pos = _JSON_STRUCTURE.match(mm, last_start).end()
+            ancestor = self._parent[last]
+            while ancestor != node:
+                closing += 1
+                ancestor = self._parent[ancestor]
+        for _ in range(closing):
+            pos = _JSON_CLOSING.match(mm, pos).end()
+        return pos
+
+    def _decode(self, start, node):
+        end = self._end(start, node)
+        return json.loads(self._mmap[start:end])
+
+    def _container(self, node):
+        """Decode the container of a node, the last one is kept for its siblings."""
+        parent = self._parent[node]
+        if self._last_container[0] != parent:
+            start = self._root if parent < 0 else self._values[parent]
+            self._last_container = (parent, self._decode(start, parent))
+        return self._last_container[1]
+
+    def _path(self, node):
+        keys = []
+        while node >= 0:
+            key = self._keys[node]
+            keys.append(-1 - key if key < 0 else self._decode(key, node))
+            node = self._parent[node]
+        return _format_path(reversed(keys))
+
+    def _string_matcher(self, offsets, value):
+        """Match the JSON strings at the offsets with a str, decoding them only if escaped."""
+        mm, encoded = self._mmap, json.dumps(value, ensure_ascii=False).encode()
+        size = len(encoded)
+
+        def match(node):
+            start = offsets[node]
+            if start < 0 or mm[start] != 0x22:
+                return False
+            if mm.find(encoded, start, start + size) == start:
+                return True
+            if not self._escaped:
+                return False
+            end = _JSON_STRUCTURE.match(mm, start).end()
+            return mm.find(b"\\", start, end) != -1 and json.loads(mm[start:end]) == value
+
+        return match
+
+    def _key_matcher(self, key):
+        if isinstance(key, str):
+            return self._string_matcher(self._keys, key)
+        keys = self._keys
+        if isinstance(key, (int, float)):  # JSON keys are strings, only list indexes can match
+            return lambda node: keys[node] < 0 and -1 - keys[node] == key
+        return lambda node: False
+
+    def _value_matcher(self, value):
+        if isinstance(value, str):
+            return self._string_matcher(self._values, value)
+        mm, values = self._mmap, self._values
+        if isinstance(value, (dict, list)):
+            first = 0x7B if isinstance(value, dict) else 0x5B
+
+            def match(node):
+                return mm[values[node]] == first and self._decode(values[node], node) == value
+
+            return match
+        if isinstance(value, tuple):
+            return lambda node: False
+        return lambda node: mm[values[node]] not in b'"{[' and (
+            self._decode(values[node], node) == value
+        )
+
+    def _scan(self, match):
+        """Yield the nodes that match in traversal order, not looking inside matches like find()."""
+        skip = self._skip
+        node, count = 0, len(skip)
+        while node < count:
+            if match(node):
+                yield node
+                node = skip[node]
+            else:
+                node += 1
+
+    def _matches(self, match):
+        for node in self._scan(match):
+            yield self._container(node), self._path(node)
+
+    def find_keys(self, key):
+        return self._matches(self._key_matcher(key))
+
+    def find_values(self, value):
+        return self._matches(self._value_matcher(value))
+
+    def find_keyvalues(self, key, value):
+        match_key, match_value = self._key_matcher(key), self._value_matcher(value)
+        return self._matches(lambda node: match_key(node) and match_value(node))
+
+    def find_any_keyvalues(self, var):
+        match_key, match_value = self._key_matcher(var), self._value_matcher(var)
+        return self._matches(lambda node: match_key(node) or match_value(node))
+
+    def find_key(self, key):
+        self.path = None
+        self.result = None
+        for node in self._scan(self._key_matcher(key)):
+            self.path = self._path(node)
+            self.result = self._decode(self._values[node], node)
+            return self.result
+        return None
+
+
+class NestedStream:
+    """
+    Search a JSON or YAML document with an incremental parser while it is read from a file object.
+
+    Only the keys leading to the current node are kept in memory, so memory use does not grow with
+    the size of the input. As containers are never built, matches are yielded as tuples of the
+    matched value and its path rather than of the container. Values are matched against scalars
+    only. A non-seekable file object can only be searched once. JSON is parsed with a pure Python
+    parser, or with use_ijson=True in binary files with the faster ijson when it is installed. Its
+    C backend can not parse integers beyond 64 bits, so only use it where there are none.
+
+    :param fileobj: A file object opened in text or binary (UTF-8) mode.
+    :param format: "json" or "yaml".
+    :param chunk_size: The number of characters or bytes to read at a time.
+    :param use_ijson: If True, parse JSON in binary files with ijson when it is installed.
+    """
+
+    def __init__(self, fileobj, format="json", chunk_size=64 * 1024, use_ijson=False):
+        if format not in ("json", "yaml"):
+            raise ValueError(f"Unsupported stream format: {format!r}")
+        self.fileobj = fileobj
+        self.format = format
+        self.chunk_size = chunk_size
+        self.use_ijson = use_ijson
+        self.result = None  # The most recently found result.
+        self.path = None  # The path to the most recently found result.
+        self._start = fileobj.tell() if fileobj.seekable() else None
+        self._consumed = False
+
+    def events(self):
+        """
+        Parse the document into a flat stream of events.
+
+        :return: A generator of (event, data) tuples, event is one of "map_start", "key", "map_end",
+            "list_start", "list_end" or "scalar".
+        """
+        if self._consumed:
+            if self._start is None:
+                raise RuntimeError("The stream has already been read and can not seek back")
+            self.fileobj.seek(self._start)
+        self._consumed = True
+        if self.format == "yaml":
+            return _iter_yaml_events(self.fileobj)
+        if self.use_ijson and isinstance(self.fileobj.read(0), bytes):
+            try:
+                import ijson  # Optional C accelerated parser, only reads binary files
+            except ImportError:
+                pass
+            else:
+                return _iter_ijson_events(ijson, self.fileobj, self.chunk_size)
+        return _iter_json_events(_iter_json_tokens(self.fileobj.read, self.chunk_size))
+
+    def _search(self, key=None, value=None, match_key=False, match_value=False):
+        """
+        Walk the events and yield the values that match the key and/or the scalar value.
+
+        A value matched by key is built from its events, so its subtree is not searched any further.
+
+        :yield: A generator that yields tuples of the value and its path.
+        """
+        if match_value and isinstance(value, (dict, list, tuple)):
+            raise TypeError("Only scalar values can be matched in a stream")
+        events = self.events()
+        stack = []  # [is_map, key or index] of every open container
+        keys = []
+        for event, data in events:
+            if event == "key":
+                stack[-1][1] = data
+            elif event in ("map_end", "list_end"):
+                stack.pop()
+                if stack:
+                    keys.pop()
+                    _next_event_index(stack)
+            elif not stack:  # the root value has no key
+                if event != "scalar":
+                    stack.append([event == "map_start", 0])
+            elif (not match_key or stack[-1][1] == key) and (
+                not match_value or (event == "scalar" and data == value)
+            ):
+                path = _format_path(keys + [stack[-1][1]])
+                yield _build_event_value(event, data, events), path
+                _next_event_index(stack)
+            elif event != "scalar":
+                keys.append(stack[-1][1])
+                stack.append([event == "map_start", 0])
+            else:
+                _next_event_index(stack)
+
+    def _find_one(self, method, *args, **kwargs):
+        self.path = None
+        self.result = None
+        for value, path in method(*args, **kwargs):
+            self.path = path
+            self.result = value
+            return value
+        return None
+
+    def find_keys(self, key):
+        """
+        Find all values with matching keys.
+
+        :param key: The key to search for.
+        :return: A generator that yields tuples of the value and its path.
+        """
+        return self._search(key=key, match_key=True)
+
+    def find_values(self, value):
+        """
+        Find all scalar values equal to a given value.
+
+        :param value: The scalar value to search for.
+        :return: A generator that yields tuples of the value and its path.
+        """
+        return self._search(value=value, match_value=True)
+
+    def find_keyvalues(self, key, value):
+        """
+        Find all matching key and scalar value pairs.
+
+        :param key: The key to search for.
+        :param value: The scalar value to search for.
+        :return: A generator that yields tuples of the value and its path.
+        """
+        return self._search(key=key, value=value, match_key=True, match_value=True)
+
+    def find_key(self, key):
+        """
+        Find the value of the first matching key, reading the stream only up to it.
+
+        :param key: The key to search for.
+        :return: The value if the key is found, otherwise None.
+        """
+        return self._find_one(self.find_keys, key)
+
+    def iter_values(self, *keys):
+        """
+        Yield the values in the container at a path one by one, e.g. the items of a JSON list.
+
+        Only one value is built at a time, so a huge list can be processed in constant memory.
+
+        :param keys: The keys and indexes leading to the container, none for the root.
+        :return: A generator of the values, empty if there is no container at the path.
+        """
+        events = self.events()
+        event, _ = next(events, (None, None))
+        for key in keys:
+            event = _find_event_child(event, key, events)
+        if event not in ("map_start", "list_start"):
+            return
+        for event, data in events:
+            if event in ("map_end", "list_end"):
+                return
+            if event != "key":
+                yield _build_event_value(event, data, events)
+
+
+def _next_event_index(stack):
+    """Move on to the next index of the innermost open container if it is a list."""
+    if not stack[-1][0]:
+        stack[-1][1] += 1
+
+
+def _skip_event_value(event, events):
+    """Consume the events of the value starting with the given event."""
+    if event not in ("map_start", "list_start"):
+        return
+    depth = 1
+    for event, _ in events:
+        if event in ("map_start", "list_start"):
+            depth += 1
+        elif event in ("map_end", "list_end"):
+            depth -= 1
+            if not depth:
+                return
+
+
+def _find_event_child(event, key, events):
+    """Consume the events up to the child at key of the container starting with the given event."""
+    if event == "map_start":
+        for event, data in events:
+            if event == "map_end":
+                return None
+            value_event = next(events)[0]
+            if data == key:
+                return value_event
+            _skip_event_value(value_event, events)
+    elif event == "list_start" and isinstance(key, int):
+        for index, (event, _) in enumerate(events):
+            if event == "list_end":
+                return None
+            if index == key:
+                return event
+            _skip_event_value(event, events)
+    return None
+
+
+def _build_event_value(event, data, events):
+    """Build the value starting with the given event from the following events."""
+    if event == "scalar":
+        return data
+    root = {} if event == "map_start" else []
+    stack = [[root, None]]
+    for event, data in events:
+        if event == "key":
+            stack[-1][1] = data
+            continue
+        if event in ("map_end", "list_end"):
+            stack.pop()
+            if not stack:
+                return root
+            continue
+        container, key = stack[-1]
+        value = data if event == "scalar" else {} if event == "map_start" else []
+        if isinstance(container, dict):
+            container[key] = value
+        else:
+            container.append(value)
+        if event != "scalar":
+            stack.append([value, None])
+    raise ValueError("Unexpected end of stream")
+
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_JSON_STRUCTURE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]|[^\s{}\[\]:,"]+')
+_JSON_CLOSING = re.compile(rb"\s*[}\]]")
+_JSON_DELIMITERS = " \t\n\r,:]}"
+_JSON_TOKEN = re.compile(
+    r"""[ \t\n\r]*(?:
+        ([{}\[\],:])
+        | "([^"\\\x00-\x1f]*)"
+        | (-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?)(?=[ \t\n\r,:\]}])
+        | (true|false|null|NaN|Infinity|-Infinity)(?=[ \t\n\r,:\]}])
+    )""",
+    re.VERBOSE,
+)
+_JSON_LITERALS = (
+    ("true", True),
+    ("false", False),
+    ("null", None),
+    ("NaN", float("nan")),
+    ("Infinity", float("inf")),
+    ("-Infinity", float("-inf")),
+)
+_JSON_LITERAL_VALUES = dict(_JSON_LITERALS)
+
+
+def _scan_json_value(buf, pos):
+    """Scan a JSON number or literal, return the value and the end position."""
+    match = NUMBER_RE.match(buf, pos)
+    if match is not None:
+        integer, frac, exp = match.groups()
+        if frac or exp:
+            return float(integer + (frac or "") + (exp or "")), match.end()
+        return int(integer), match.end()
+    for literal, value in _JSON_LITERALS:
+        if buf.startswith(literal, pos):
+            return value, pos + len(literal)
+    raise JSONDecodeError("Expecting value", buf, pos)
+
+
+def _iter_json_tokens(read, chunk_size):
+    """
+    Split JSON text read in chunks into tokens.
+
+    Most tokens are matched by one regular expression, escaped strings, numbers or literals at the
+    end of the buffer and errors take the slow path.
+
+    :param read: A callable returning the next chunk of str or UTF-8 bytes, empty at the end.
+    :param chunk_size: The size passed to read().
+    :yield: Tuples of token and value, token is one of "{}[],:", "str" or "val".
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    match_token = _JSON_TOKEN.match
+    buf = ""
+    pos = 0
+    eof = False
+    while True:
+        match = match_token(buf, pos)
+        if match is not None:
+            pos = match.end()
+            yield _json_match_token(match)
+            continue
+        pos = _JSON_WHITESPACE.match(buf, pos).end()
+        scanned = _scan_json_token(buf, pos, eof) if pos < len(buf) else None
+        if scanned is not None:
+            token, value, pos = scanned
+            yield token, value
+            continue
+        if eof:
+            return
+        chunk = read(chunk_size)
+        eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk, final=eof)
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def _json_match_token(match):
+    """Get the token and value of a match of _JSON_TOKEN."""
+    kind = match.lastindex
+    if kind == 1:
+        return match.group(1), None
+    if kind == 2:
+        return "str", match.group(2)
+    if kind == 4:
+        return "val", _JSON_LITERAL_VALUES[match.group(4)]
+    number = match.group(3)
+    if "." in number or "e" in number or "E" in number:
+        return "val", float(number)
+    return "val", int(number)
+
+
+def _scan_json_token(buf, pos, eof):
+    """
+    Scan a string, number or literal token that _JSON_TOKEN did not match.
+
+    :return: The token, value and end position, or None if more input is needed.
+    """
+    try:
+        if buf[pos] == '"':
+            value, end = scanstring(buf, pos + 1)
+            token = "str"
+        else:
+            value, end = _scan_json_value(buf, pos)
+            token = "val"
+    except JSONDecodeError:
+        if eof:
+            raise
+        return None
+    # a number is only complete when followed by a delimiter, it could go on
+    if token == "str" or eof or (end < len(buf) and buf[end] in _JSON_DELIMITERS):
+        return token, value, end
+    return None
+
+
+def _iter_json_events(tokens):
+    """
+    Turn JSON tokens into events, checking the grammar.
+
+    :param tokens: Tokens from _iter_json_tokens().
+    :yield: Tuples of event and data, see NestedStream.events().
+    """
+    stack = []
+    state = "value"
+    for token, value in tokens:
+        event, state = _JSON_STATES[state](token, value, state, stack)
+        if state is None:
+            break
+        if event is not None:
+            yield event
+    else:
+        if state == "next" and not stack:
+            return
+        raise ValueError("Unexpected end of JSON stream")
+    raise ValueError(f"Unexpected {token if value is None else value!r} in JSON stream")
+
+
+def _json_value_event(token, value, state, stack):
+    """
+    Handle a token where a value is expected.
+
+    :return: The event or None, and the next state or None if the token is not allowed.
+    """
+    if token in ("str", "val"):
+        return ("scalar", value), "next"
+    if token == "{":
+        stack.append("}")
+        return ("map_start", None), "first_key"
+    if token == "[":
+        stack.append("]")
+        return ("list_start", None), "first_item"
+    if token == "]" and state == "first_item":
+        stack.pop()
+        return ("list_end", None), "next"
+    return None, None
+
+
+def _json_key_event(token, value, state, stack):
+    """Handle a token where a key is expected, see _json_value_event()."""
+    if token == "str":
+        return ("key", value), "colon"
+    if token == "}" and state == "first_key":
+        stack.pop()
+        return ("map_end", None), "next"
+    return None, None
+
+
+def _json_separator_event(token, value, state, stack):
+    """Handle a token after a key or a value, see _json_value_event()."""
+    if state == "colon":
+        return None, "value" if token == ":" else None
+    if stack and token == ",":
+        return None, "key" if stack[-1] == "}" else "value"
+    if stack and token == stack[-1]:
+        stack.pop()
+        return ("map_end" if token == "}" else "list_end", None), "next"
+    return None, None
+
+
+_JSON_STATES = {
+    "value": _json_value_event,
+    "first_item": _json_value_event,
+    "key": _json_key_event,
+    "first_key": _json_key_event,
+    "colon": _json_separator_event,
+    "next": _json_separator_event,
+}
+
+_IJSON_EVENTS = {
+    "start_map": "map_start",
+    "map_key": "key",
+    "end_map": "map_end",
+    "start_array": "list_start",
+    "end_array": "list_end",
+}
+
+
+def _iter_ijson_events(ijson, fileobj, chunk_size):
+    """Turn ijson parser events into events, see NestedStream.events()."""
+    events = _IJSON_EVENTS
+    try:
+        for event, value in ijson.basic_parse(fileobj, use_float=True, buf_size=chunk_size):
+            yield events.get(event, "scalar"), value
+    except ijson.JSONError as exc:
+        raise ValueError(f"Invalid JSON stream: {exc}") from exc
+
+
+def _iter_yaml_events(stream):
+    """
+    Turn a YAML stream into events with the PyYAML event parser, only the first document is read.
+
+    :param stream: A file object.
+    :yield: Tuples of event and data, see NestedStream.events().
+    """
+    import yaml  # Lazy import, base only needs the standard library
+
+    from xenoslib.yaml_utils import SafeLoader
+
+    loader = SafeLoader(stream)
+    stack = []  # "key" or "value" for a mapping by what comes next, "item" for a sequence
+    try:
+        while loader.check_event():
+            event = loader.get_event()
+            if isinstance(event, yaml.DocumentEndEvent):
+                return
+            if isinstance(event, yaml.AliasEvent):
+                raise ValueError("YAML aliases are not supported in a stream")
+            if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+                yield _open_yaml_container(stack, isinstance(event, yaml.MappingStartEvent))
+            elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+                stack.pop()
+                yield "map_end" if isinstance(event, yaml.MappingEndEvent) else "list_end", None
+                _close_yaml_value(stack)
+            elif isinstance(event, yaml.ScalarEvent):
+                value = _construct_yaml_scalar(yaml, loader, event)
+                if stack and stack[-1] == "key":
+                    stack[-1] = "value"
+                    yield "key", value
+                else:
+                    yield "scalar", value
+                    _close_yaml_value(stack)
+    finally:
+        loader.dispose()
+
+
+def _open_yaml_container(stack, is_map):
+    """Push a mapping or sequence on the stack of _iter_yaml_events() and get its start event."""
+    if stack and stack[-1] == "key":
+        raise ValueError("Only scalar keys are supported in a YAML stream")
+    stack.append("key" if is_map else "item")
+    return "map_start" if is_map else "list_start", None
+
+
+def _close_yaml_value(stack):
+    """After a value of a mapping, its next key is expected."""
+    if stack and stack[-1] == "value":
+        stack[-1] = "key"
+
+
+def _construct_yaml_scalar(yaml, loader, event):
+    """Build the value of a scalar event like the loader would."""
+    tag = event.tag
+    if tag is None or tag == "!":
+        tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+    node = yaml.ScalarNode(tag, event.value, style=event.style)
+    constructor = loader.yaml_constructors.get(tag, loader.yaml_constructors[None])
+    return constructor(loader, node)
+
+
 class Singleton:
     """Please note that __init__() will still run every time"""
 
@@ -398,6 +1933,61 @@ def get_attr_val(obj, *args):
     return {attr: getattr(obj, attr) for attr in args}
 
 
+def _create_temp_file(directory, prefix):
+    """
+    Create a new file with a random name, with the permissions 0o666 less the umask, unlike mkstemp().
+
+    :return: The file descriptor, opened for writing, and the path of the file.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    while True:
+        path = os.path.join(directory, f"{prefix}{os.urandom(6).hex()}")
+        try:
+            return os.open(path, flags, 0o666), path
+        except FileExistsError:
+            continue
+
+
+def atomic_write(filepath, data, encoding="utf-8", mode=None):
+    """
+    Replace a file's content atomically, readers see either the old or the new file, never a part.
+
+    The data goes to a temporary file in the same directory, which is flushed to disk and renamed
+    over filepath.
+
+    :param filepath: The path of the file.
+    :param data: The str or bytes to write.
+    :param encoding: The encoding of str data.
+    :param mode: The permission bits, by default those of the existing file or from the umask.
+    """
+    if isinstance(data, str):
+        data = data.encode(encoding)
+    directory = os.path.dirname(os.path.abspath(filepath))
+    if mode is None:
+        try:
+            mode = os.stat(filepath).st_mode & 0o7777
+        except FileNotFoundError:
+            pass  # a new file, the kernel applies the umask to 0o666
+    fd, tmp_path = _create_temp_file(directory, f".{os.path.basename(filepath)}.")
+    try:
+        with os.fdopen(fd, "wb") as w:
+            w.write(data)
+            w.flush()
+            os.fsync(w.fileno())
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if hasattr(os, "O_DIRECTORY"):  # make the rename itself durable
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
 if __name__ == "__main__":
 
     init_logger()
@@ -2,19 +2,69 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import copy
+import json
+import base64
+import binascii
+import http.client
+import atexit
+import hashlib
+import contextlib
 import logging
+import threading
+import urllib.parse
+from collections import namedtuple
+from concurrent.futures import Future
 
-import yaml
 import requests
 
+try:
+    import fcntl
+except ImportError:  # Windows, only the in-process lock is used
+    fcntl = None
+
+from xenoslib.base import NestedStream, atomic_write
 from xenoslib.tools import ConfigLoader  # noqa compactive
+from xenoslib.tools import TokenBucket
+from xenoslib.yaml_utils import yaml_dump, yaml_load_file
 
 
 logger = logging.getLogger(__name__)
 
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses"])
+_BatchRequest = namedtuple("_BatchRequest", ["request", "future", "depends"])
+
+
+def _batch_body(body, content_type):
+    """the content of a batched response, whose body is JSON, text, or else base64"""
+    mime_type = (content_type or "").split(";")[0].strip().lower()
+    if body is None:
+        return b""
+    if not isinstance(body, str) or mime_type.endswith(("/json", "+json")):
+        return json.dumps(body).encode()
+    if mime_type.startswith("text/"):
+        return body.encode()
+    try:
+        return base64.b64decode(body, validate=True)
+    except binascii.Error:
+        logger.debug(f"Batched response body is not base64: {body[:100]!r}")
+        return body.encode()
+
 
 class YamlConfig(dict):
-    """A thread unsafe yaml file config utility , can work as a dict except __init__"""
+    """
+    A thread unsafe yaml file config utility , can work as a dict except __init__, see
+    ConcurrentYamlConfig for a thread and process safe one
+
+    Every YamlConfig(path) reloads the file, with check_stat = True (on the class or a subclass) it
+    is only parsed again when its mtime, size or inode changed, see cache_info(). With
+    use_snapshot = True the parsed file is cached in a binary snapshot, see yaml_load_file().
+    With save_delay > 0 save() is deferred, see save().
+    """
+
+    check_stat = False
+    use_snapshot = False
+    save_delay = 0
 
     def __getattr__(self, key):
         return self.get(key)
@@ -30,7 +80,7 @@ class YamlConfig(dict):
         raise AttributeError(f"'{__class__.__name__}' object attribute '{name}' is read-only")
 
     def __str__(self):
-        return yaml.safe_dump(self.copy(), allow_unicode=True)
+        return yaml_dump(self.copy())
 
     def __repr__(self):
         return repr(str(self))
@@ -39,40 +89,556 @@ class YamlConfig(dict):
         pass
 
     def __new__(cls, conf_path="config.yml", *args, **kwargs):
-        if not hasattr(cls, "_instances"):
+        instance = cls._get_instance(conf_path)
+        instance._load_conf()
+        return instance
+
+    @classmethod
+    def _get_instance(cls, conf_path):
+        """Get the instance of a path from the registry, creating it unloaded if missing."""
+        if "_instances" not in cls.__dict__:  # not shared with subclasses
             cls._instances = {}
-        if cls._instances.get(conf_path) is None:
-            cls._instances[conf_path] = super().__new__(cls)
-            super().__setattr__(cls._instances[conf_path], "_conf_path", conf_path)
-        cls._instances[conf_path]._load_conf()
-        return cls._instances[conf_path]
+        instance = cls._instances.get(conf_path)
+        if instance is None:
+            instance = super().__new__(cls)
+            super().__setattr__(instance, "_conf_path", conf_path)
+            super().__setattr__(instance, "_stat", False)
+            super().__setattr__(instance, "_hits", 0)
+            super().__setattr__(instance, "_misses", 0)
+            super().__setattr__(instance, "_saved_digest", None)
+            super().__setattr__(instance, "_save_timer", None)
+            super().__setattr__(instance, "_save_pending", False)
+            super().__setattr__(instance, "_lock", threading.RLock())
+            super().__setattr__(instance, "_flush_at_exit", False)
+            cls._instances[conf_path] = instance
+        return instance
+
+    def _get_stat(self):
+        try:
+            stat = os.stat(self._conf_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
 
     def _load_conf(self):
+        stat = self._get_stat() if self.check_stat else None
+        if not self._is_fresh(stat):
+            self._apply_conf(self._read_conf(), stat)
+
+    def _is_fresh(self, stat):
+        """Tell if the file is as last parsed with check_stat, counting the hits and misses."""
+        if not self.check_stat:
+            return False
+        fresh = stat == self._stat
+        counter = "_hits" if fresh else "_misses"
+        super().__setattr__(counter, getattr(self, counter) + 1)
+        return fresh
+
+    def _apply_conf(self, data, stat):
+        """Update the config with the parsed file, and remember its stat with check_stat."""
+        if data is not None:
+            self.update(data)
+        if self.check_stat:
+            super().__setattr__("_stat", stat)
+
+    def _read_conf(self):
+        """Parse the file, None if it does not exist."""
         if os.path.exists(self._conf_path):
-            with open(self._conf_path, encoding="utf-8") as r:
-                self.update(yaml.safe_load(r))
+            return yaml_load_file(self._conf_path, snapshot=self.use_snapshot)
+        return None
+
+    def cache_info(self):
+        """
+        Get how often construction skipped (hits) or did (misses) parsing with check_stat.
+
+        :return: A CacheInfo named tuple.
+        """
+        return CacheInfo(self._hits, self._misses)
 
     def save(self):
-        data = str(self)
-        with open(self._conf_path, "w", encoding="utf-8") as w:
-            w.write(data)
-            # yaml.safe_dump(self.copy(), w, allow_unicode=True)
+        """
+        Write the config to its file.
+
+        The file is replaced atomically, and not written at all if the content did not change
+        since the last write. With save_delay > 0 (seconds) the write happens in the background
+        after the delay, so every save() within it is done by a single write, and a pending write
+        is done at exit. Call flush() to write it immediately. A failed background write is logged
+        and stays pending. The background write copies the config under the instance lock, which
+        only ConcurrentYamlConfig takes for changes, so use it to change the config meanwhile.
+        """
+        if self.save_delay <= 0:
+            self.flush()
+            return
+        with self._lock:
+            super().__setattr__("_save_pending", True)
+            if self._save_timer is not None:
+                return
+            timer = threading.Timer(self.save_delay, self._deferred_flush)
+            timer.daemon = True
+            if not self._flush_at_exit:
+                atexit.register(self._flush_pending)
+                super().__setattr__("_flush_at_exit", True)
+            super().__setattr__("_save_timer", timer)
+            timer.start()
+
+    def flush(self):
+        """Write the config to its file now, cancelling any pending deferred write."""
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                super().__setattr__("_save_timer", None)
+            data = yaml_dump(copy.deepcopy(dict(self)))
+            digest = hashlib.sha256(data.encode("utf-8")).digest()
+            if digest != self._saved_digest:
+                atomic_write(self._conf_path, data)
+                super().__setattr__("_saved_digest", digest)
+                if self.check_stat:  # the file now matches the config, no need to parse it again
+                    super().__setattr__("_stat", self._get_stat())
+            super().__setattr__("_save_pending", False)
+
+    def _deferred_flush(self):
+        with self._lock:
+            if self._save_timer is threading.current_thread():
+                super().__setattr__("_save_timer", None)  # a save() from now on needs a new write
+            try:
+                self.flush()
+            except Exception:
+                logger.exception(f"Failed to save {self._conf_path}, will retry")
+
+    def _flush_pending(self):
+        if self._save_pending:
+            self.flush()
+
+
+class ConcurrentYamlConfig(YamlConfig):
+    """
+    A YamlConfig that can be shared by threads and processes.
+
+    Changes through the dict methods are serialized by a lock per instance, and loading and saving
+    hold an advisory fcntl lock on a "<path>.lock" file, shared while loading so only writers
+    wait. Loading parses the file without the instance lock and takes it only to update the dict,
+    so constructions do not wait for each other. Reads are plain dict reads, they take no lock and
+    never block. Changes inside nested values are not locked, use locked() to update them.
+    """
+
+    _new_lock = threading.Lock()
+
+    @classmethod
+    def _get_instance(cls, conf_path):
+        with cls._new_lock:  # only the registry, not the loading
+            return super()._get_instance(conf_path)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """Hold the lock file exclusively, under the instance lock so threads never share it."""
+        depth = self.__dict__.get("_file_lock_depth", 0)
+        if fcntl is None or depth:
+            yield
+            return
+        if self.__dict__.get("_lock_pid") != os.getpid():  # a forked child needs its own lock
+            fd = os.open(f"{self._conf_path}.lock", os.O_RDWR | os.O_CREAT, 0o666)
+            dict.__setattr__(self, "_lock_fd", fd)
+            dict.__setattr__(self, "_lock_pid", os.getpid())
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        dict.__setattr__(self, "_file_lock_depth", 1)
+        dict.__setattr__(self, "_file_lock_owner", threading.get_ident())
+        try:
+            yield
+        finally:
+            dict.__setattr__(self, "_file_lock_owner", None)
+            dict.__setattr__(self, "_file_lock_depth", 0)
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def _shared_file_lock(self):
+        """Hold the lock file shared, on a descriptor of its own so no instance lock is needed."""
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(f"{self._conf_path}.lock", os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(fd)  # releases the lock
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Lock the config against all other threads and processes for a read-modify-write update.
+
+        On entry the config is replaced by the content of the file, so keys that others removed
+        are gone too, and it is written on exit, usage:
+        with config.locked():
+            config["counter"] += 1
+        """
+        with self._lock, self._file_lock():
+            if self.check_stat:
+                dict.__setattr__(self, "_stat", self._get_stat())
+            data = self._read_conf()
+            if data is not None:
+                dict.clear(self)
+                dict.update(self, data)
+            yield self
+            self.flush()
+
+    def _load_conf(self):
+        if self.__dict__.get("_file_lock_owner") == threading.get_ident():  # in locked()
+            with self._lock:
+                super()._load_conf()
+            return
+        stat = self._get_stat() if self.check_stat else None
+        if self._is_fresh(stat):
+            return
+        with self._shared_file_lock():
+            data = self._read_conf()
+        with self._lock:
+            self._apply_conf(data, stat)
+
+    def flush(self):
+        with self._lock, self._file_lock():
+            super().flush()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+
+    def pop(self, *args):
+        with self._lock:
+            return super().pop(*args)
+
+    def popitem(self):
+        with self._lock:
+            return super().popitem()
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        with self._lock:
+            super().update(*args, **kwargs)
 
 
 class RequestAdapter:
-    def request(self, method, path, *args, **kwargs):
-        """to-do: support stream=True"""
+    """
+    retry_policy: a RetryPolicy to retry failed requests after a backoff, None to raise at once
+    rate_limit: the requests per second to each host, a token bucket shared by all adapters in
+    the process with the same rate_limit and rate_burst, None for no limit
+    rate_burst: the requests to a host that may be sent at once, defaults to rate_limit
+    response_cache: a ResponseCache to revalidate repeated GETs of JSON with ETag or Last-Modified
+    and reuse the cached body on 304, every call gets a body of its own
+    batch_path: the path of the JSON batch endpoint that enables batch(), e.g. "$batch"
+    batch_size: the maximum number of requests per batch
+    """
+
+    retry_policy = None
+    rate_limit = None
+    rate_burst = None
+    response_cache = None
+    batch_path = None
+    batch_size = 20
+    _rate_limiters = {}
+    _rate_limiters_lock = threading.Lock()
+
+    def request(
+        self,
+        method,
+        path,
+        *args,
+        stream=False,
+        items=None,
+        chunk_size=64 * 1024,
+        use_ijson=False,
+        depends_on=None,
+        **kwargs,
+    ):
+        """
+        return the decoded JSON body, or the response if the body is not JSON
+        stream=True: return an iterator of the body in chunks of chunk_size bytes instead
+        items: return an iterator of the values in the JSON container at that key or keys path,
+        e.g. "value" for {"value": [...]} or () for a top-level list, parsed one at a time
+        use_ijson=True: parse items with ijson if installed, faster but limited to 64 bit integers
+        streamed bodies are never read whole, nor logged; close the iterator to stop early
+        within batch(): return a Future of the result, depends_on: the futures to run after
+        """
         url = f"{self.base_url}/{path}"
         logger.debug(url)
-        response = self.session.request(method, url, *args, **kwargs)
-        logger.debug(response.text)
-        response.raise_for_status()
+        streaming = bool(stream or items is not None)
+        pending = getattr(self.__dict__.get("_batch_local"), "pending", None)
+        if pending is not None and not streaming:
+            return self._queue_batch_request(
+                pending, method, url, *args, depends_on=depends_on, **kwargs
+            )
+        if self.response_cache is not None and method.upper() == "GET" and not streaming:
+            return self._cached_request(url, *args, **kwargs)
+        response = self._send(method, url, *args, stream=streaming, **kwargs)
+        if streaming:
+            return self._iter_response(response, items, chunk_size, use_ijson)
         try:
             return response.json()
         except Exception as exc:
             logger.debug(exc)
             return response
 
+    def _cached_request(self, url, *args, **kwargs):
+        """send a conditional GET with the validators of the cached response, if any"""
+        cache = self.response_cache
+        params, headers = kwargs.get("params"), kwargs.get("headers")
+        prepared = self.session.prepare_request(
+            requests.Request("GET", url, params=params, headers=headers)
+        )
+        key = cache.make_key("GET", prepared.url, prepared.headers)
+        cached = cache.get(key)
+        if cached is not None:
+            headers = dict(headers or {})
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+            kwargs["headers"] = headers
+        response = self._send("get", url, *args, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            logger.debug(f"Not modified, reused cached response of {url}")
+            return json.loads(cached.content)
+        try:
+            body = response.json()
+        except Exception as exc:
+            logger.debug(exc)
+            return response
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if (etag or last_modified) and "no-store" not in response.headers.get("Cache-Control", ""):
+            cache.set(key, etag, last_modified, response.text)
+        return body
+
+    def _rate_limiter(self, url):
+        if not self.rate_limit:
+            return None
+        key = urllib.parse.urlsplit(url).netloc, self.rate_limit, self.rate_burst
+        with self._rate_limiters_lock:
+            limiter = self._rate_limiters.get(key)
+            if limiter is None:
+                limiter = TokenBucket(self.rate_limit, self.rate_burst)
+                self._rate_limiters[key] = limiter
+        return limiter
+
+    def _retry_delay(self, method, attempt, response):
+        """the seconds to wait before retrying a response and its Retry-After, None to not retry"""
+        policy = self.retry_policy
+        if policy is None or not policy.is_retryable(method, attempt, response.status_code):
+            return None, None
+        retry_after = response.headers.get("Retry-After")
+        return policy.delay(attempt, retry_after), retry_after
+
+    @staticmethod
+    def _checked(response):
+        """return the response, or close it and raise HTTPError for an error status"""
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+        return response
+
+    def _send(self, method, url, *args, **kwargs):
+        """send a request with rate limiting and retries, return the successful response"""
+        policy = self.retry_policy
+        limiter = self._rate_limiter(url)
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                response = self.session.request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                if policy is None or not policy.is_retryable(method, attempt):
+                    raise
+                delay, reason = policy.delay(attempt), exc
+            else:
+                if not kwargs.get("stream") and logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(response.text)
+                delay, retry_after = self._retry_delay(method, attempt, response)
+                if delay is None:
+                    return self._checked(response)
+                response.close()
+                reason = f"HTTP {response.status_code}"
+                if limiter is not None and retry_after is not None:
+                    limiter.pause(delay)  # the server is throttling every request to the host
+            logger.warning(f"Retrying {method} {url} in {delay:.2f}s after {reason}")
+            policy.sleep(delay)
+            attempt += 1
+
+    @contextlib.contextmanager
+    def batch(self, sequential=False):
+        """
+        queue the requests of this thread and send them at the end of the block as JSON batches
+        (https://learn.microsoft.com/en-us/graph/json-batching) of up to batch_size requests
+        each request returns a Future of its result instead, the requests run in any order unless
+        they depend on others with depends_on=[future, ...], or with sequential=True each one on
+        the previous one; a request fails with HTTP 424 if a request it depends on failed
+        throttled requests are retried with retry_policy, only JSON request bodies are supported
+        nothing is sent if the block raises, a nested batch() is part of the outer one
+        usage：
+        with onedrive.batch():
+            items = [onedrive.get_path(path) for path in paths]
+        print([item.result()["id"] for item in items])
+        """
+        if not self.batch_path:
+            raise TypeError(f"{type(self).__name__} has no batch_path")
+        local = self.__dict__.setdefault("_batch_local", threading.local())
+        if getattr(local, "pending", None) is not None:
+            yield self
+            return
+        local.pending, local.sequential = [], sequential
+        try:
+            yield self
+        except BaseException:
+            for queued in local.pending:
+                queued.future.cancel()
+            raise
+        finally:
+            pending, local.pending = local.pending, None
+        self._send_batch(pending)
+
+    def _queue_batch_request(
+        self,
+        pending,
+        method,
+        url,
+        *args,
+        depends_on=None,
+        params=None,
+        json=None,
+        headers=None,
+        **kwargs,
+    ):
+        if args or kwargs:
+            raise ValueError(f"Only params, json and headers can be batched, not {args or kwargs}")
+        parts = urllib.parse.urlsplit(requests.Request(method, url, params=params).prepare().url)
+        base_length = len(urllib.parse.urlsplit(self.base_url).path.rstrip("/"))
+        relative_url = "/" + parts.path[base_length:].lstrip("/")
+        if parts.query:
+            relative_url += f"?{parts.query}"
+        request = {"id": str(len(pending) + 1), "method": method.upper(), "url": relative_url}
+        headers = dict(headers or {})
+        if json is not None:
+            request["body"] = json
+            headers.setdefault("Content-Type", "application/json")
+        if headers:
+            request["headers"] = headers
+        depends = list(depends_on or ())
+        if self._batch_local.sequential and pending:
+            depends.append(pending[-1].future)
+        future = Future()
+        pending.append(_BatchRequest(request, future, depends))
+        return future
+
+    def _send_batch(self, pending):
+        """send the queued requests in batches, then again those throttled until they are done"""
+        pending = [queued for queued in pending if queued.future.set_running_or_notify_cancel()]
+        attempt = 0
+        while pending:
+            retries, delays = set(), [0]
+            for start in range(0, len(pending), self.batch_size):
+                group, end = [], start + self.batch_size
+                for queued in pending[start:end]:
+                    if any(future in retries for future in queued.depends):
+                        retries.add(queued.future)
+                    elif any(
+                        future.done() and (future.cancelled() or future.exception())
+                        for future in queued.depends
+                    ):
+                        response = self._batch_response(queued, {"status": 424})
+                        message = f"424 Client Error: Failed Dependency for url: {response.url}"
+                        queued.future.set_exception(requests.HTTPError(message, response=response))
+                    else:
+                        group.append(queued)
+                if group:
+                    self._send_batch_group(group, attempt, retries, delays)
+            pending = [queued for queued in pending if queued.future in retries]
+            if pending:
+                logger.warning(f"Retrying {len(pending)} batched requests in {max(delays):.2f}s")
+                self.retry_policy.sleep(max(delays))
+                attempt += 1
+
+    def _send_batch_group(self, group, attempt, retries, delays):
+        ids = {queued.future: queued.request["id"] for queued in group}
+        batch = []
+        for queued in group:
+            depends = [ids[future] for future in queued.depends if future in ids]
+            batch.append({**queued.request, "dependsOn": depends} if depends else queued.request)
+        try:
+            response = self._send(
+                "post", f"{self.base_url}/{self.batch_path}", json={"requests": batch}
+            )
+            results = {result["id"]: result for result in response.json()["responses"]}
+        except Exception as exc:
+            for queued in group:
+                queued.future.set_exception(exc)
+            return
+        for queued in group:
+            result = results.get(queued.request["id"], {"status": 502})
+            self._resolve_batch_result(queued, result, attempt, retries, delays)
+
+    def _resolve_batch_result(self, queued, result, attempt, retries, delays):
+        """set the future of a batched request, or add it to retries if it is to be sent again"""
+        response = self._batch_response(queued, result)
+        policy, delay = self.retry_policy, None
+        if policy is not None and policy.is_retryable(
+            queued.request["method"], attempt, response.status_code
+        ):
+            delay = policy.delay(attempt, response.headers.get("Retry-After"))
+        if delay is not None or (
+            response.status_code == 424 and any(future in retries for future in queued.depends)
+        ):
+            retries.add(queued.future)
+            delays.append(delay or 0)
+            return
+        try:
+            response.raise_for_status()
+        except Exception as exc:
+            queued.future.set_exception(exc)
+            return
+        try:
+            queued.future.set_result(response.json())
+        except Exception as exc:
+            logger.debug(exc)
+            queued.future.set_result(response)
+
+    def _batch_response(self, queued, result):
+        """build a response from the result of a batched request"""
+        response = requests.Response()
+        response.status_code = result["status"]
+        response.reason = http.client.responses.get(response.status_code, "")
+        response.headers = requests.structures.CaseInsensitiveDict(result.get("headers") or {})
+        response.url = f"{self.base_url}{queued.request['url']}"
+        response.encoding = "utf-8"
+        response._content = _batch_body(result.get("body"), response.headers.get("Content-Type"))
+        return response
+
+    @staticmethod
+    def _iter_response(response, items, chunk_size, use_ijson):
+        with response:
+            if items is None:
+                yield from response.iter_content(chunk_size)
+                return
+            response.raw.decode_content = True  # gzip etc.
+            keys = (items,) if isinstance(items, (str, int)) else tuple(items)
+            stream = NestedStream(response.raw, chunk_size=chunk_size, use_ijson=use_ijson)
+            yield from stream.iter_values(*keys)
+
     def get(self, path, *args, **kwargs):
         return self.request("get", path, *args, **kwargs)
 
@@ -95,6 +661,89 @@ class RequestAdapter:
         self.session = requests.Session()
 
 
+class AsyncRequestAdapter:
+    """
+    asyncio version of RequestAdapter, all requests share one pooled aiohttp session
+    limit: the maximum number of connections, limit_per_host: the maximum per host
+    usage：
+    class Api(AsyncRequestAdapter):
+        base_url = "https://example.com/api"
+
+    async with Api(limit_per_host=50) as api:
+        items = await asyncio.gather(*(api.get(f"items/{i}") for i in range(500)))
+    """
+
+    base_url = ""
+
+    def __init__(self, limit=100, limit_per_host=10, timeout=60, headers=None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self._session = None
+
+    @property
+    def session(self):
+        """the aiohttp.ClientSession, created in the running event loop on first use"""
+        if self._session is None or self._session.closed:
+            try:
+                import aiohttp  # Lazy import
+            except ImportError as e:
+                raise ImportError(
+                    "aiohttp package is required for AsyncRequestAdapter. "
+                    "Install with: pip install xenoslib[async]"
+                ) from e
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers=self.headers,
+            )
+        return self._session
+
+    async def request(self, method, path, *args, **kwargs):
+        url = f"{self.base_url}/{path}"
+        logger.debug(url)
+        async with self.session.request(method, url, *args, **kwargs) as response:
+            text = await response.text()  # read the body so the connection is released
+            logger.debug(text)
+            response.raise_for_status()
+        try:
+            return json.loads(text)
+        except Exception as exc:
+            logger.debug(exc)
+            return response
+
+    async def get(self, path, *args, **kwargs):
+        return await self.request("get", path, *args, **kwargs)
+
+    async def post(self, path, *args, **kwargs):
+        return await self.request("post", path, *args, **kwargs)
+
+    async def put(self, path, *args, **kwargs):
+        return await self.request("put", path, *args, **kwargs)
+
+    async def delete(self, path, *args, **kwargs):
+        return await self.request("delete", path, *args, **kwargs)
+
+    async def patch(self, path, *args, **kwargs):
+        return await self.request("patch", path, *args, **kwargs)
+
+    async def head(self, path, *args, **kwargs):
+        return await self.request("head", path, *args, **kwargs)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
 def del_to_recyclebin(filepath, on_fail_delete=False):
     """delete file to recyclebin if possible"""
     if not sys.platform == "win32":
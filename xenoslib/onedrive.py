@@ -7,6 +7,7 @@ import requests
 
 from xenoslib.base import ArgMethodBase
 from xenoslib.extend import RequestAdapter, YamlConfig
+from xenoslib.tools import RetryPolicy
 
 
 logger = logging.getLogger(__name__)
@@ -19,6 +20,8 @@ class OneDrive(RequestAdapter):
     """
 
     base_url = "https://graph.microsoft.com/v1.0"
+    retry_policy = RetryPolicy()  # Graph throttles with 429 and 503 responses and Retry-After
+    batch_path = "$batch"  # https://learn.microsoft.com/en-us/graph/json-batching
     auth_url_template = "https://login.microsoftonline.com/{tenant}/oauth2/v2.0/token"
 
     # https://portal.azure.com/#blade/Microsoft_AAD_RegisteredApps/ApplicationsListBlade
@@ -1 +1,6 @@
 from .config_loader import ConfigLoader  # noqa
+from .file_watcher import FileWatcher  # noqa
+from .secret_cache import SecretCache  # noqa
+from .vault_pool import VaultClientPool  # noqa
+from .retry_policy import RetryPolicy, TokenBucket  # noqa
+from .response_cache import ResponseCache  # noqa
@@ -2,15 +2,28 @@
 # -*- coding: utf-8 -*-
 import os
 import logging
-
-import yaml
+import functools
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 from xenoslib.base import SingletonWithArgs
+from xenoslib.tools.file_watcher import FileWatcher
+from xenoslib.tools.secret_cache import SecretCache
+from xenoslib.tools.vault_pool import VaultClientPool
+from xenoslib.yaml_utils import yaml_dump, yaml_load_file
 
 
 logger = logging.getLogger(__name__)
 
 
+def _vault_errors():
+    """Get hvac.exceptions, only imported once a Vault call failed."""
+    import hvac.exceptions  # Lazy import
+
+    return hvac.exceptions
+
+
 class ConfigLoader(SingletonWithArgs):
     """Centralized configuration management with optional Vault integration.
 
@@ -20,7 +33,13 @@ class ConfigLoader(SingletonWithArgs):
             If provided, enables Vault functionality and imports hvac module.
 
     Attributes:
-        cache (dict): Cache storage for frequently accessed configuration values.
+        cache (SecretCache): Cache of Vault values, shared by all instances. Values are fresh
+            for 5 minutes and refreshed in the background when read near expiry, assign a
+            SecretCache with other settings to change that.
+        vault_pool (VaultClientPool): The Vault clients by namespace, shared by threads, created
+            with vault_secret_id. vault_client is its client of the login namespace.
+        use_snapshot (bool): Cache the parsed file in a binary snapshot next to it, see
+            xenoslib.yaml_utils.yaml_load_file(). Defaults to False.
 
     Example:
         # Without Vault (hvac not imported)
@@ -34,28 +53,113 @@ class ConfigLoader(SingletonWithArgs):
 
         # Write to Vault using dictionary style
         >>> config["test_section"]["test_key"] = "new_value"
+
+        # Reload in the background when the file changes, instead of on every ConfigLoader()
+        >>> config.watch().on_change("test_section", lambda section, old, new: print(new))
     """
 
     VAULT_SUFFIX = "@vault"
     KV_MOUNT_POINT = "kv"
+    CAS_RETRIES = 5
 
-    cache = {}
+    cache = SecretCache(maxsize=1024, ttl=300)
     vault_client = None
+    vault_pool = None
+    use_snapshot = False
+    _watcher = None
+    _callbacks = None
 
     def __init__(self, config_file_path="config.yml", vault_secret_id=None):
         """Initialize the ConfigLoader with a configuration file and optional Vault secret."""
-        with open(config_file_path, "r") as f:
-            config_data = yaml.safe_load(f)
-            self._raw_config = config_data if isinstance(config_data, dict) else {}
+        self._config_file_path = config_file_path
+        if "_local" not in self.__dict__:
+            self._local = threading.local()  # the pending writes of batch() by thread
+        if self._watcher is None:  # else the watcher keeps it up to date
+            self._raw_config = self._load_config()
 
         if vault_secret_id is not None:
             self.vault_secret_id = vault_secret_id
             self._check_and_renew_vault_client()
 
+    def _load_config(self):
+        config_data = yaml_load_file(self._config_file_path, snapshot=self.use_snapshot)
+        return config_data if isinstance(config_data, dict) else {}
+
+    def reload(self):
+        """Re-read the configuration file and notify the callbacks of changed sections.
+
+        The new configuration replaces the old one in a single assignment, so readers see either
+        one of them completely. Cached Vault values of changed sections are dropped.
+
+        Returns:
+            list: The names of the changed sections.
+        """
+        old_config, new_config = self._raw_config, self._load_config()
+        changed = [
+            section
+            for section in old_config.keys() | new_config.keys()
+            if old_config.get(section) != new_config.get(section)
+        ]
+        self._raw_config = new_config
+        for cache_key in list(self.cache):
+            if cache_key.split(":", 1)[0] in changed:
+                self.cache.pop(cache_key, None)
+        for section in changed:
+            for callback in (self._callbacks or {}).get(section, []):
+                try:
+                    callback(section, old_config.get(section), new_config.get(section))
+                except Exception:
+                    logger.exception(f"Config change callback failed for section '{section}'")
+        return changed
+
+    def _on_file_change(self, filepath):
+        try:
+            self.reload()
+        except Exception:
+            logger.exception(f"Failed to reload {filepath}, keeping the current configuration")
+
+    def watch(self, interval=1.0):
+        """Reload the configuration in a background thread whenever the file changes.
+
+        While watching, ConfigLoader(...) no longer reads the file.
+
+        Args:
+            interval (float): Seconds between checks when inotify is not available.
+
+        Returns:
+            ConfigLoader: self.
+        """
+        if self._watcher is None:
+            self._watcher = FileWatcher(self._config_file_path, self._on_file_change, interval)
+            self._watcher.start()
+        return self
+
+    def unwatch(self):
+        """Stop watching the configuration file."""
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def on_change(self, section, callback):
+        """Register a callback for changes of a section by reload().
+
+        Args:
+            section (str): The section name.
+            callback (callable): Called with the section name, its old and its new configuration,
+                either may be None if the section was added or removed.
+
+        Returns:
+            ConfigLoader: self.
+        """
+        if self._callbacks is None:
+            self._callbacks = {}
+        self._callbacks.setdefault(section, []).append(callback)
+        return self
+
     def _init_vault_client(self):
         """Initialize and authenticate the Vault client (imports hvac on demand)."""
         try:
-            import hvac  # Lazy import
+            import hvac  # noqa: F401 Lazy import
         except ImportError as e:
             raise ImportError(
                 "hvac package is required for Vault integration. Install with: pip install hvac"
@@ -70,18 +174,28 @@ class ConfigLoader(SingletonWithArgs):
             if not all([vault_url, vault_space, vault_role_id]):
                 raise KeyError("Missing required Vault configuration in config.yml")
 
-            self.vault_client = hvac.Client(url=vault_url, namespace=vault_space, timeout=45)
-            self.vault_client.auth.approle.login(
-                role_id=vault_role_id, secret_id=self.vault_secret_id
+            self.vault_pool = VaultClientPool(
+                vault_url, vault_space, vault_role_id, self.vault_secret_id, timeout=45
             )
+            self.vault_client = self.vault_pool.client()
         except Exception as e:
+            self.vault_pool = None
             self.vault_client = None
             raise Exception(f"Failed to initialize Vault client: {str(e)}") from e
 
     def _check_and_renew_vault_client(self):
-        if not self.vault_client or not self.vault_client.is_authenticated():
+        if self.vault_pool is not None:
+            self.vault_pool.ensure_token()
+        elif not self.vault_client or not self.vault_client.is_authenticated():
             self._init_vault_client()
 
+    def _vault_client_for(self, namespace):
+        """Get a client for a namespace, from the pool or by switching the single client."""
+        if self.vault_pool is not None:
+            return self.vault_pool.client(namespace)
+        self.vault_client.adapter.namespace = namespace
+        return self.vault_client
+
     def _is_vault_reference(self, section_config, key_name):
         """检查键是否是Vault引用"""
         return f"{key_name}{self.VAULT_SUFFIX}" in section_config
@@ -102,10 +216,14 @@ class ConfigLoader(SingletonWithArgs):
                 )
 
             cache_key = f"{section}:{key_name}"
-            if use_cache and cache_key in self.cache:
-                return self.cache[cache_key]
-            value = self._get_value_from_vault(section, key_name)
-            self.cache[cache_key] = value
+
+            def load():
+                return self._get_value_from_vault(section, key_name)
+
+            if use_cache:
+                return self.cache.get(cache_key, load)
+            value = load()
+            self.cache.set(cache_key, value, load)
             return value
 
         raise KeyError(f"Key '{key_name}' not found in section '{section}'")
@@ -122,32 +240,169 @@ class ConfigLoader(SingletonWithArgs):
         if self.vault_client is None:
             raise Exception(f"Vault access required for {key_name} but Vault is not initialized")
 
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            vault_key = section_config[f"{key_name}{self.VAULT_SUFFIX}"]
+            updates = pending.setdefault(self._vault_location(section), {})
+            updates[vault_key] = (section, key_name, value, use_cache)
+            return
+
         self._set_value_to_vault(section, key_name, value)
+        self._update_cache(section, key_name, value, use_cache)
 
+    def _update_cache(self, section, key_name, value, use_cache):
         cache_key = f"{section}:{key_name}"
         if use_cache:
-            self.cache[cache_key] = value
+            self.cache.set(cache_key, value, lambda: self._get_value_from_vault(section, key_name))
+        else:
+            self.cache.pop(cache_key)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collect the set() calls of this thread and write them together at the end of the block.
+
+        All values under the same vault_path are written with one read and one check-and-set
+        write, so a concurrent writer's changes to other keys are kept, and the write is
+        retried up to CAS_RETRIES times when such a writer got in between. Nothing is written
+        if the block raises, and a nested batch() is part of the outer one.
+
+        Example:
+            >>> with config.batch():
+            ...     config.database.user = "app"
+            ...     config.database.password = "secret"
+        """
+        if getattr(self._local, "pending", None) is not None:
+            yield self
+            return
+        self._local.pending = {}
+        try:
+            yield self
+            pending = self._local.pending
+        finally:
+            self._local.pending = None
+        if not pending:
+            return
+        self._check_and_renew_vault_client()
+        for (namespace, vault_path), updates in pending.items():
+            values = {vault_key: update[2] for vault_key, update in updates.items()}
+            try:
+                self._write_vault_secret(namespace, vault_path, values)
+            except Exception as e:
+                raise Exception(f"Failed to write {vault_path} to Vault: {str(e)}") from e
+            for section, key_name, value, use_cache in updates.values():
+                self._update_cache(section, key_name, value, use_cache)
+
+    def _vault_location(self, section):
+        """Get the (namespace, vault_path) of the secret of a section."""
+        section_config = self._raw_config[section]
+        vault_path = section_config.get("vault_path")
+        if not vault_path:
+            raise KeyError(f"Missing vault_path in section '{section}'")
+        namespace = section_config.get("vault_namespace") or self._raw_config["vault"]["space"]
+        return namespace, vault_path
+
+    def _read_vault_secret(self, namespace, vault_path):
+        """Read all keys of the secret at a path."""
+
+        def read():
+            return self._vault_client_for(namespace).secrets.kv.read_secret_version(
+                path=vault_path, mount_point=self.KV_MOUNT_POINT, raise_on_deleted_version=True
+            )
+
+        return self._with_vault_login(read)["data"]["data"]
+
+    def _with_vault_login(self, func, *args):
+        """Call func, once more after logging in again if Vault rejected the pooled token."""
+        try:
+            return func(*args)
+        except Exception as e:
+            if self.vault_pool is None or not isinstance(e, self.vault_pool.auth_errors):
+                raise
+            self.vault_pool.invalidate()  # the token was revoked, log in again once
+            return func(*args)
 
     def _get_value_from_vault(self, section, key_name):
         """Retrieve a secret value from Vault."""
         try:
-            section_config = self._raw_config[section]
-            vault_path = section_config.get("vault_path")
-            if not vault_path:
-                raise KeyError(f"Missing vault_path in section '{section}'")
+            namespace, vault_path = self._vault_location(section)
+            vault_key = self._raw_config[section][f"{key_name}{self.VAULT_SUFFIX}"]
+            return self._read_vault_secret(namespace, vault_path)[vault_key]
+        except Exception as e:
+            raise Exception(f"Failed to fetch {key_name} from Vault: {str(e)}") from e
 
-            vault_key_ref = f"{key_name}{self.VAULT_SUFFIX}"
-            vault_key = section_config[vault_key_ref]
+    def prefetch(self, section=None, max_workers=8):
+        """Read the Vault values of a section, or of all sections, into the cache.
 
-            namespace = section_config.get("vault_namespace") or self._raw_config["vault"]["space"]
-            self.vault_client.adapter.namespace = namespace
+        Each distinct (namespace, vault_path) is read once for all its keys, and the paths are
+        read concurrently. With a vault_client but no vault_pool, that client has a single
+        current namespace, so only paths in the same namespace are read concurrently.
 
-            data = self.vault_client.secrets.kv.read_secret_version(
-                path=vault_path, mount_point=self.KV_MOUNT_POINT, raise_on_deleted_version=True
+        Args:
+            section (str, optional): The section, all sections if None.
+            max_workers (int): The maximum number of concurrent reads.
+
+        Returns:
+            int: The number of values cached.
+        """
+        if self.vault_client is None:
+            raise Exception("Vault access required for prefetch but Vault is not initialized")
+        if section is not None and section not in self._raw_config:
+            raise KeyError(f"Section '{section}' not found")
+        paths = self._prefetch_paths(self._raw_config if section is None else [section])
+        count = 0
+        batches = [paths] if self.vault_pool else [{ns: keys} for ns, keys in paths.items()]
+        with ThreadPoolExecutor(max_workers) as executor:
+            for batch in batches:
+                futures = {
+                    (namespace, vault_path): executor.submit(
+                        self._read_vault_secret, namespace, vault_path
+                    )
+                    for namespace, path_keys in batch.items()
+                    for vault_path in path_keys
+                }
+                for (namespace, vault_path), future in futures.items():
+                    try:
+                        secret_data = future.result()
+                    except Exception as e:
+                        raise Exception(f"Failed to prefetch {vault_path} from Vault: {e}") from e
+                    keys = paths[namespace][vault_path]
+                    count += self._cache_prefetched(vault_path, keys, secret_data)
+        return count
+
+    def _prefetch_paths(self, sections):
+        """Group the Vault references of sections by namespace and vault_path.
+
+        Returns:
+            dict: namespace -> vault_path -> [(section, key_name, vault_key)].
+        """
+        paths = {}
+        for name in sections:
+            section_config = self._raw_config[name]
+            if not isinstance(section_config, dict):
+                continue
+            refs = [ref for ref in section_config if str(ref).endswith(self.VAULT_SUFFIX)]
+            if not refs:
+                continue
+            namespace, vault_path = self._vault_location(name)
+            keys = paths.setdefault(namespace, {}).setdefault(vault_path, [])
+            for ref in refs:
+                keys.append((name, ref[: -len(self.VAULT_SUFFIX)], section_config[ref]))
+        return paths
+
+    def _cache_prefetched(self, vault_path, keys, secret_data):
+        """Cache the values of a secret read by prefetch(), return how many were cached."""
+        count = 0
+        for name, key_name, vault_key in keys:
+            if vault_key not in secret_data:
+                logger.warning(f"Key {vault_key} not found in {vault_path}")
+                continue
+            self.cache.set(
+                f"{name}:{key_name}",
+                secret_data[vault_key],
+                functools.partial(self._get_value_from_vault, name, key_name),
             )
-            return data["data"]["data"][vault_key]
-        except Exception as e:
-            raise Exception(f"Failed to fetch {key_name} from Vault: {str(e)}") from e
+            count += 1
+        return count
 
     def _set_value_to_vault(self, section, key_name, value):
         """Set a secret value to Vault."""
@@ -163,26 +418,50 @@ class ConfigLoader(SingletonWithArgs):
             vault_key = section_config[vault_key_ref]
 
             namespace = section_config.get("vault_namespace") or self._raw_config["vault"]["space"]
-            self.vault_client.adapter.namespace = namespace
+            self._write_vault_secret(namespace, vault_path, {vault_key: value})
+        except Exception as e:
+            raise Exception(f"Failed to set {key_name} to Vault: {str(e)}") from e
 
+    def _write_vault_secret(self, namespace, vault_path, values):
+        """Update keys of the secret at a path, keeping the others, with check-and-set."""
+        for attempt in range(1, self.CAS_RETRIES + 1):
             try:
-                data = self.vault_client.secrets.kv.read_secret_version(
-                    path=vault_path, mount_point=self.KV_MOUNT_POINT, raise_on_deleted_version=True
-                )
-                secret_data = data["data"]["data"]
-            except Exception:
-                logger.warning(f"Secret not found, creating new secret at {vault_path}")
-                secret_data = {}
-
-            secret_data[vault_key] = value
-
-            self.vault_client.secrets.kv.create_or_update_secret(
-                path=vault_path, secret=secret_data, mount_point=self.KV_MOUNT_POINT
-            )
-
-            logger.info(f"Updated Vault secret: {vault_path}/{vault_key}")
+                self._with_vault_login(self._check_and_set, namespace, vault_path, values)
+            except Exception as e:
+                conflict = isinstance(e, _vault_errors().InvalidRequest)
+                if not conflict or attempt == self.CAS_RETRIES:
+                    raise
+                logger.info(f"Vault secret {vault_path} changed meanwhile, retry {attempt}")
+                continue
+            logger.info(f"Updated Vault secret: {vault_path}/{', '.join(map(str, values))}")
+            return
+
+    def _check_and_set(self, namespace, vault_path, values):
+        """Read the secret and write it back updated, unless it changed in between."""
+        client = self._vault_client_for(namespace)
+        secret_data, version = self._read_secret_for_update(client, vault_path)
+        secret_data.update(values)
+        client.secrets.kv.create_or_update_secret(
+            path=vault_path,
+            secret=secret_data,
+            cas=version,
+            mount_point=self.KV_MOUNT_POINT,
+        )
+
+    def _read_secret_for_update(self, client, vault_path):
+        """Read the data and version of a secret, ({}, 0) for a secret that does not exist yet."""
+        try:
+            data = client.secrets.kv.read_secret_version(
+                path=vault_path,
+                mount_point=self.KV_MOUNT_POINT,
+                raise_on_deleted_version=False,
+            )["data"]
         except Exception as e:
-            raise Exception(f"Failed to set {key_name} to Vault: {str(e)}") from e
+            if not isinstance(e, _vault_errors().InvalidPath):
+                raise
+            logger.warning(f"Secret not found, creating new secret at {vault_path}")
+            return {}, 0
+        return data["data"] or {}, data["metadata"]["version"]
 
     def __getitem__(self, section):
         """Dictionary-style access to configuration sections."""
@@ -244,7 +523,7 @@ class SectionProxy:
 
     def __repr__(self):
         """String representation of the section's configuration."""
-        return yaml.dump(self.to_dict())
+        return yaml_dump(self.to_dict())
 
     def __contains__(self, key):
         return key in self.self.to_dict()
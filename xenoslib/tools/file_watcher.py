@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import ctypes
+import ctypes.util
+import errno
+import select
+import struct
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_inotify():
+    """Get libc with inotify, or None where it is not available."""
+    if sys.platform != "linux":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if hasattr(libc, "inotify_init1") and hasattr(libc, "inotify_add_watch"):
+            return libc
+    except OSError:
+        pass
+    return None
+
+
+class FileWatcher:
+    """Call a function in a background thread whenever a file changes.
+
+    Polls os.stat() every interval, and where inotify is available also wakes up on any event in
+    the file's directory and in the directory of the file a symlink points to, so saves that
+    replace the file, edits of a symlink's target and swaps of a symlinked directory such as a
+    Kubernetes ConfigMap's ..data are seen at once. A change is a different (mtime_ns, size,
+    inode) of the file, so events that leave it as it was do not call the function.
+
+    Args:
+        filepath (str): The file to watch.
+        callback (callable): Called with filepath after each change.
+        interval (float): Seconds between polls, also how long stop() may take.
+        use_inotify (bool): Set to False to always poll.
+
+    Example:
+        >>> watcher = FileWatcher("config.yml", print).start()
+        >>> watcher.stop()
+    """
+
+    def __init__(self, filepath, callback, interval=1.0, use_inotify=True):
+        self.filepath = os.path.abspath(filepath)
+        self.callback = callback
+        self.interval = interval
+        self.use_inotify = use_inotify
+        self._stop = threading.Event()
+        self._thread = None
+        self._signature = self._get_signature()
+
+    def _get_signature(self):
+        try:
+            stat = os.stat(self.filepath)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _check(self):
+        """Call the callback if the file changed since the last check."""
+        signature = self._get_signature()
+        if signature == self._signature:
+            return
+        self._signature = signature
+        if signature is None:  # deleted, wait for the new file
+            return
+        try:
+            self.callback(self.filepath)
+        except Exception:
+            logger.exception(f"Callback failed for change of {self.filepath}")
+
+    def _init_inotify(self):
+        """Watch the directories, return the inotify fd or None to poll."""
+        libc = _load_inotify() if self.use_inotify else None
+        if libc is None:
+            return None
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            logger.debug(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+            return None
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        target = os.path.realpath(self.filepath)
+        for directory in {os.path.dirname(self.filepath), os.path.dirname(target)}:
+            if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+                logger.debug(f"inotify_add_watch failed: {os.strerror(ctypes.get_errno())}")
+                os.close(fd)
+                return None
+        return fd
+
+    @staticmethod
+    def _read_events(fd):
+        """Drain the pending inotify events, tell if a watch was removed with its directory."""
+        ignored = False
+        while True:
+            try:
+                buf = os.read(fd, 64 * 1024)
+            except OSError as exc:
+                if exc.errno == errno.EAGAIN:
+                    return ignored
+                raise
+            pos = 0
+            while pos < len(buf):
+                _, mask, _, size = _EVENT_HEADER.unpack_from(buf, pos)
+                pos += _EVENT_HEADER.size + size
+                ignored = ignored or bool(mask & IN_IGNORED)
+
+    def _run(self):
+        fd = self._init_inotify()
+        try:
+            while not self._stop.is_set():
+                self._check()
+                if fd is None:
+                    self._stop.wait(self.interval)
+                elif select.select([fd], [], [], self.interval)[0] and self._read_events(fd):
+                    # the directory is gone or a symlink now points elsewhere, watch anew or poll
+                    os.close(fd)
+                    fd = self._init_inotify()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def start(self):
+        """Start watching in a daemon thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="FileWatcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop watching and wait for the thread to end."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import re
+import json
+import hashlib
+import contextlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+from xenoslib.base import atomic_write
+
+logger = logging.getLogger(__name__)
+
+_ENTRY_FILE = re.compile(r"[0-9a-f]{64}\.json")
+
+CachedResponse = namedtuple("CachedResponse", ["etag", "last_modified", "content"])
+
+
+class ResponseCache:
+    """LRU cache of JSON HTTP response bodies with their validators, for conditional requests.
+
+    Entries keep the ETag and Last-Modified of a response with its JSON text, so a repeated request
+    can send If-None-Match and If-Modified-Since and parse the body again on 304 Not Modified, see
+    RequestAdapter.response_cache. Keeping the text rather than the parsed body means no caller can
+    change the cached body of another. With a directory the entries are also written there as JSON
+    files, which outlive the process and the in-memory eviction. Keys are hashes of the method,
+    the URL and the request headers in vary, so credentials are not stored in them.
+
+    Args:
+        maxsize (int): The maximum number of entries in memory.
+        directory (str, optional): The directory of the on-disk tier, created if missing.
+        vary (iterable): The request headers that select a different response.
+
+    Example:
+        >>> class Api(RequestAdapter):
+        ...     response_cache = ResponseCache(directory=os.path.expanduser("~/.cache/api"))
+    """
+
+    def __init__(
+        self,
+        maxsize=256,
+        directory=None,
+        vary=("Accept", "Accept-Language", "Authorization", "Prefer"),
+    ):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.vary = tuple(vary)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._metrics = dict.fromkeys(("hits", "disk_hits", "misses", "evictions"), 0)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def make_key(self, method, url, headers):
+        """Get the key of a request.
+
+        Args:
+            method (str): The request method.
+            url (str): The full URL, with the query string.
+            headers (Mapping): The request headers, case insensitive like requests' headers.
+
+        Returns:
+            str: The key.
+        """
+        parts = [method.upper(), url]
+        parts.extend(f"{name}: {headers.get(name, '')}" for name in self.vary)
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """Get an entry, from memory or else from disk.
+
+        Args:
+            key (str): The key from make_key().
+
+        Returns:
+            CachedResponse: The entry, or None.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+                self._metrics["hits"] += 1
+                return entry
+        if self.directory:
+            try:
+                with open(self._disk_path(key), encoding="utf-8") as r:
+                    entry = CachedResponse(**json.load(r))
+            except FileNotFoundError:
+                pass
+            except Exception as exc:
+                logger.debug(f"Ignored invalid cached response {key}: {exc}")
+            if entry is not None:
+                self._store(key, entry)
+                with self._lock:
+                    self._metrics["disk_hits"] += 1
+                return entry
+        with self._lock:
+            self._metrics["misses"] += 1
+        return None
+
+    def set(self, key, etag, last_modified, content):
+        """Store the validators and JSON body of a response.
+
+        Args:
+            key (str): The key from make_key().
+            etag (str): The ETag header, or None.
+            last_modified (str): The Last-Modified header, or None.
+            content (str): The JSON body as text.
+        """
+        entry = CachedResponse(etag, last_modified, content)
+        self._store(key, entry)
+        if self.directory:
+            try:
+                atomic_write(self._disk_path(key), json.dumps(entry._asdict()), mode=0o600)
+            except Exception as exc:
+                logger.debug(f"Failed to write cached response {key}: {exc}")
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._metrics["evictions"] += 1
+
+    def pop(self, key):
+        """Remove an entry from memory and disk."""
+        with self._lock:
+            self._data.pop(key, None)
+        if self.directory:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._disk_path(key))
+
+    def clear(self):
+        """Remove all entries from memory and disk, other files in the directory are kept."""
+        with self._lock:
+            self._data.clear()
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if _ENTRY_FILE.fullmatch(name):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(self.directory, name))
+
+    def metrics(self):
+        """Get the counts of memory hits, disk hits, misses and evictions.
+
+        Returns:
+            dict: A copy of the counters.
+        """
+        with self._lock:
+            return dict(self._metrics)
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+import random
+import logging
+import threading
+import email.utils
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"))
+
+
+class RetryPolicy:
+    """When and how long to wait before retrying a failed HTTP request.
+
+    A request is retried after a connection error or one of the statuses, if its method is one of
+    methods, at most total times. The wait is the server's Retry-After when given, otherwise an
+    exponential backoff of backoff * 2 ** attempt seconds capped at max_backoff, with full jitter
+    so that clients failing together do not retry together. A Retry-After longer than
+    max_retry_after is not waited for, the error is raised instead.
+
+    Args:
+        total (int): The maximum number of retries of a request.
+        backoff (float): Seconds of the first backoff, doubled for every retry.
+        max_backoff (float): The maximum backoff in seconds.
+        jitter (bool): Wait a random time up to the backoff rather than the backoff itself.
+        statuses (iterable): The response statuses to retry.
+        methods (iterable): The methods to retry, defaults to the idempotent ones, add "POST" or
+            "PATCH" only where sending the request twice is harmless.
+        max_retry_after (float): The longest Retry-After in seconds to wait for.
+        sleep (callable): Waits the given seconds, defaults to time.sleep.
+
+    Example:
+        >>> class Api(RequestAdapter):
+        ...     retry_policy = RetryPolicy(total=3, methods={"GET", "POST"})
+    """
+
+    def __init__(
+        self,
+        total=5,
+        backoff=0.5,
+        max_backoff=60,
+        jitter=True,
+        statuses=(429, 500, 502, 503, 504),
+        methods=IDEMPOTENT_METHODS,
+        max_retry_after=300,
+        sleep=time.sleep,
+    ):
+        self.total = total
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(method.upper() for method in methods)
+        self.max_retry_after = max_retry_after
+        self.sleep = sleep
+
+    def is_retryable(self, method, attempt, status=None):
+        """Tell if a request may be retried.
+
+        Args:
+            method (str): The request method.
+            attempt (int): The number of retries done so far.
+            status (int, optional): The response status, None after a connection error.
+
+        Returns:
+            bool: True to retry.
+        """
+        if attempt >= self.total or method.upper() not in self.methods:
+            return False
+        return status is None or status in self.statuses
+
+    def delay(self, attempt, retry_after=None):
+        """Get the seconds to wait before a retry.
+
+        Args:
+            attempt (int): The number of retries done so far.
+            retry_after (str, optional): The Retry-After header, seconds or an HTTP date.
+
+        Returns:
+            float: The seconds to wait, or None if Retry-After is longer than max_retry_after.
+        """
+        seconds = parse_retry_after(retry_after)
+        if seconds is not None:
+            return seconds if seconds <= self.max_retry_after else None
+        seconds = min(self.max_backoff, self.backoff * 2**attempt)
+        return random.uniform(0, seconds) if self.jitter else seconds
+
+
+def parse_retry_after(value):
+    """Get the seconds to wait from a Retry-After header.
+
+    Args:
+        value (str): The header, delay seconds or an HTTP date.
+
+    Returns:
+        float: The seconds, never negative, or None if value is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.debug(f"Ignored invalid Retry-After: {value!r}")
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class TokenBucket:
+    """Thread safe token bucket rate limiter.
+
+    Tokens are added at rate per second up to capacity, and every acquire() takes one, so bursts
+    of up to capacity calls pass at once and the average stays at rate. Callers that find no token
+    reserve the next ones and sleep until then, in the order they came. pause() makes all callers
+    wait, for example for a Retry-After that applies to every request to a host.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float, optional): The maximum number of tokens, defaults to rate or 1.
+        timer (callable): Returns the current time in seconds, defaults to time.monotonic.
+        sleep (callable): Waits the given seconds, defaults to time.sleep.
+
+    Example:
+        >>> bucket = TokenBucket(10)
+        >>> for path in paths:
+        ...     bucket.acquire()
+        ...     api.get(path)
+    """
+
+    def __init__(self, rate, capacity=None, timer=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.timer = timer
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._updated = timer()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        """Add the tokens since the last update, called with the lock held."""
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def acquire(self, tokens=1):
+        """Take tokens, waiting until they are available.
+
+        Args:
+            tokens (float): The number of tokens to take.
+
+        Returns:
+            float: The seconds waited.
+        """
+        with self._lock:
+            now = self.timer()
+            self._refill(now)
+            self._tokens -= tokens
+            wait = self._updated - now + max(0, -self._tokens) / self.rate
+        if wait > 0:
+            self.sleep(wait)
+        return max(0, wait)
+
+    def pause(self, seconds):
+        """Hand out no tokens for the given seconds, and none saved up before."""
+        with self._lock:
+            now = self.timer()
+            self._refill(now)
+            self._tokens = min(self._tokens, 0)
+            self._updated = max(self._updated, now + seconds)
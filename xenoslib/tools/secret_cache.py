@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("value", "loader", "loaded_at")
+
+    def __init__(self, value, loader, loaded_at):
+        self.value = value
+        self.loader = loader
+        self.loaded_at = loaded_at
+
+
+class SecretCache:
+    """Bounded, expiring cache that refreshes entries in the background before they expire.
+
+    An entry is fresh for ttl seconds. A hit on an entry older than refresh_ahead * ttl returns
+    it and reloads it in a background thread, so frequently read entries never expire and reads
+    never wait for the loader. Entries older than ttl are only returned (while being reloaded) if
+    max_age allows, anything older than max_age is loaded again before returning. The least
+    recently used entries are evicted beyond maxsize.
+
+    Args:
+        maxsize (int): The maximum number of entries.
+        ttl (float): Seconds an entry is fresh.
+        max_age (float, optional): Seconds an entry may be returned at all, defaults to ttl.
+        refresh_ahead (float): Fraction of ttl after which a hit starts a background refresh.
+        executor (Executor, optional): Runs the refreshes, defaults to a ThreadPoolExecutor with
+            refresh_workers threads created when first needed.
+        refresh_workers (int): Threads of the default executor.
+        timer (callable): Returns the current time in seconds, defaults to time.monotonic.
+
+    Example:
+        >>> cache = SecretCache(ttl=300, max_age=900)
+        >>> password = cache.get("db:password", lambda: read_secret("db", "password"))
+        >>> cache.metrics()
+        {'hits': 0, 'misses': 1, 'stale_hits': 0, 'refreshes': 0, 'refresh_errors': 0, 'evictions': 0}
+    """
+
+    def __init__(
+        self,
+        maxsize=1024,
+        ttl=300,
+        max_age=None,
+        refresh_ahead=0.8,
+        executor=None,
+        refresh_workers=2,
+        timer=time.monotonic,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_age = ttl if max_age is None else max(ttl, max_age)
+        self.refresh_ahead = refresh_ahead
+        self.refresh_workers = refresh_workers
+        self.timer = timer
+        self._executor = executor
+        self._data = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._metrics = dict.fromkeys(
+            ("hits", "misses", "stale_hits", "refreshes", "refresh_errors", "evictions"), 0
+        )
+
+    def get(self, key, loader):
+        """Get a value, calling loader() for it if it is missing or too old.
+
+        Args:
+            key: The cache key.
+            loader (callable): Returns the current value, also used for background refreshes.
+
+        Returns:
+            The cached or loaded value.
+        """
+        now = self.timer()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                age = now - entry.loaded_at
+                if age < self.max_age:
+                    self._data.move_to_end(key)
+                    self._metrics["hits" if age < self.ttl else "stale_hits"] += 1
+                    entry.loader = loader
+                    if age >= self.ttl * self.refresh_ahead:
+                        self._schedule_refresh(key, entry)
+                    return entry.value
+            self._metrics["misses"] += 1
+        value = loader()
+        self._store(key, value, loader, now)
+        return value
+
+    def set(self, key, value, loader=None):
+        """Store a value, it is only refreshed if a loader is given now or by a later get()."""
+        self._store(key, value, loader, self.timer())
+
+    def _store(self, key, value, loader, now):
+        with self._lock:
+            self._data[key] = _Entry(value, loader, now)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._metrics["evictions"] += 1
+
+    def _schedule_refresh(self, key, entry):
+        """Reload an entry in the background, called with the lock held."""
+        if entry.loader is None or key in self._refreshing:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.refresh_workers, thread_name_prefix="SecretCache"
+            )
+        self._refreshing.add(key)
+        self._executor.submit(self._refresh, key, entry)
+
+    def _refresh(self, key, entry):
+        try:
+            now = self.timer()
+            value = entry.loader()
+        except Exception:
+            logger.exception(f"Failed to refresh cached value of {key!r}")
+            with self._lock:
+                self._metrics["refresh_errors"] += 1
+                self._refreshing.discard(key)
+            return
+        with self._lock:
+            self._refreshing.discard(key)
+            self._metrics["refreshes"] += 1
+            if self._data.get(key) is entry:  # not invalidated or replaced meanwhile
+                entry.value, entry.loaded_at = value, now
+
+    def pop(self, key, default=None):
+        """Remove an entry, returning its value."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry.value
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def metrics(self):
+        """Get the counts of hits, misses, stale hits, refreshes, refresh errors and evictions.
+
+        Returns:
+            dict: A copy of the counters.
+        """
+        with self._lock:
+            return dict(self._metrics)
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and self.timer() - entry.loaded_at < self.max_age
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
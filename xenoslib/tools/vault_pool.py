@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class VaultClientPool:
+    """Thread safe hvac clients, one per namespace, sharing a token and HTTP connections.
+
+    Every client keeps its own namespace, so threads can read from different namespaces at the
+    same time. The AppRole login happens once for all clients, and again under a lock when the
+    token is within renew_margin seconds of its lease end, so concurrent callers wait for a
+    single renewal. All clients use one requests.Session with a connection pool of pool_maxsize.
+
+    Args:
+        url (str): The Vault URL.
+        namespace (str): The namespace to log in to.
+        role_id (str): The AppRole role ID.
+        secret_id (str): The AppRole secret ID.
+        timeout (float): The request timeout in seconds.
+        pool_maxsize (int): Connections kept per host, the useful number of concurrent reads.
+        renew_margin (float): Seconds before the token lease ends to log in again.
+        client_factory (callable, optional): Called with (namespace, token) to create a client,
+            defaults to hvac.Client on the shared session.
+        timer (callable): Returns the current time in seconds, defaults to time.monotonic.
+
+    Example:
+        >>> pool = VaultClientPool("https://vault", "space", role_id, secret_id)
+        >>> pool.client("space/team").secrets.kv.read_secret_version(path="app")
+    """
+
+    def __init__(
+        self,
+        url,
+        namespace,
+        role_id,
+        secret_id,
+        timeout=45,
+        pool_maxsize=32,
+        renew_margin=60,
+        client_factory=None,
+        timer=time.monotonic,
+    ):
+        self.url = url
+        self.namespace = namespace
+        self.role_id = role_id
+        self.secret_id = secret_id
+        self.timeout = timeout
+        self.renew_margin = renew_margin
+        self.timer = timer
+        self.auth_errors = ()
+        if client_factory is None:
+            import hvac  # Lazy import
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            self.auth_errors = (hvac.exceptions.Forbidden, hvac.exceptions.Unauthorized)
+
+            def client_factory(namespace, token):
+                return hvac.Client(
+                    url=url,
+                    token=token,
+                    namespace=namespace,
+                    timeout=timeout,
+                    session=self.session,
+                )
+
+        self.client_factory = client_factory
+        self._clients = {}
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def _token_valid(self):
+        return self._token is not None and self.timer() < self._expires_at - self.renew_margin
+
+    def _login(self):
+        """Log in with AppRole and hand the token to all clients, called with the lock held."""
+        auth_client = self.client_factory(self.namespace, None)
+        response = auth_client.auth.approle.login(role_id=self.role_id, secret_id=self.secret_id)
+        lease_duration = response["auth"].get("lease_duration") or 0
+        self._token = response["auth"]["client_token"]
+        self._expires_at = self.timer() + lease_duration if lease_duration else float("inf")
+        for client in self._clients.values():
+            client.token = self._token
+        logger.debug(f"Logged in to Vault, token lease {lease_duration}s")
+
+    def ensure_token(self):
+        """Log in if there is no token or it is about to expire.
+
+        Returns:
+            str: The current token.
+        """
+        if not self._token_valid():
+            with self._lock:
+                if not self._token_valid():
+                    self._login()
+        return self._token
+
+    def invalidate(self):
+        """Forget the token, for example after Vault rejected it, the next use logs in again."""
+        with self._lock:
+            self._token = None
+
+    def client(self, namespace=None):
+        """Get the client of a namespace, with a valid token.
+
+        Args:
+            namespace (str, optional): The namespace, defaults to the login namespace.
+
+        Returns:
+            hvac.Client: The client, do not change its namespace.
+        """
+        self.ensure_token()
+        namespace = namespace or self.namespace
+        client = self._clients.get(namespace)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(namespace)
+                if client is None:
+                    client = self.client_factory(namespace, self._token)
+                    self._clients[namespace] = client
+        return client
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Safe YAML loading and dumping, with libyaml when PyYAML was built with it.
+
+The C loader and dumper are 10-50x faster on big files and accept the same safe subset of YAML,
+YAML_BACKEND tells which one is active ("libyaml" or "python").
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+
+import yaml
+
+from xenoslib.base import atomic_write
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+
+    YAML_BACKEND = "libyaml"
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+    YAML_BACKEND = "python"
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def yaml_load(stream):
+    """
+    Parse a YAML document like yaml.safe_load().
+
+    :param stream: A str, bytes or file object.
+    :return: The document as Python objects.
+    """
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def yaml_dump(data, stream=None, **kwargs):
+    """
+    Serialize data to YAML like yaml.safe_dump(), allowing unicode by default.
+
+    :param data: The Python objects to serialize.
+    :param stream: A file object to write to, if None the YAML is returned as a str.
+    :param kwargs: Other yaml.dump() options.
+    :return: The YAML str, or None when written to stream.
+    """
+    kwargs.setdefault("allow_unicode", True)
+    return yaml.dump(data, stream, Dumper=SafeDumper, **kwargs)
+
+
+def snapshot_path(filepath):
+    """
+    Get the path of the snapshot of a YAML file, a hidden file next to it.
+
+    :param filepath: The path of the YAML file.
+    :return: The path of the snapshot.
+    """
+    directory, name = os.path.split(filepath)
+    return os.path.join(directory, f".{name}.snapshot")
+
+
+def _trusted(stat):
+    """
+    Tell if a snapshot may be unpickled: owned by the current user and not writable by others.
+
+    Windows has no uid and always reports the mode 0o666, so only the file ACLs protect it there.
+    """
+    if not hasattr(os, "getuid"):
+        return True
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+def yaml_load_file(filepath, snapshot=False):
+    """
+    Parse a YAML file, optionally through a binary snapshot of the parsed data.
+
+    With snapshot=True the data is pickled to snapshot_path(filepath) after parsing, and the next
+    call unpickles it instead of parsing while the file has the same sha256, mtime and size. The
+    snapshot is written atomically with the file's permissions, and on POSIX it is only trusted when
+    owned by the current user and not writable by others, as unpickling runs code from it. A stale,
+    corrupt or unwritable snapshot falls back to parsing.
+
+    :param filepath: The path of the YAML file.
+    :param snapshot: If True, use and update the snapshot.
+    :return: The document as Python objects.
+    """
+    if not snapshot:
+        with open(filepath, encoding="utf-8") as r:
+            return yaml_load(r)
+    with open(filepath, "rb") as r:
+        content = r.read()
+        stat = os.fstat(r.fileno())
+    digest = hashlib.sha256(content).hexdigest()
+    key = (SNAPSHOT_VERSION, digest, stat.st_mtime_ns, stat.st_size)
+    cache_path = snapshot_path(filepath)
+    try:
+        with open(cache_path, "rb") as r:
+            if _trusted(os.fstat(r.fileno())) and pickle.load(r) == key:
+                return pickle.load(r)
+    except FileNotFoundError:
+        pass
+    except Exception as exc:
+        logger.debug(f"Ignored invalid snapshot {cache_path}: {exc}")
+    data = yaml_load(content)
+    try:
+        dump = pickle.dumps(key, pickle.HIGHEST_PROTOCOL) + pickle.dumps(
+            data, pickle.HIGHEST_PROTOCOL
+        )
+        atomic_write(cache_path, dump, mode=stat.st_mode & 0o777 & ~0o022)
+    except Exception as exc:
+        logger.debug(f"Failed to write snapshot {cache_path}: {exc}")
+    return data